@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""Benchmark the parsing of the `quota_history` attribute of a project.
+
+Compares a full parse of a large synthetic history, a memoized lookup
+of the same text and the incremental parse done when a quota update is
+appended to it.
+
+Usage: python benchmarks/bench_history.py [--lines N]
+"""
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import random
+import time
+
+from scadmin.models.projects import (
+    _history_cache, _parse_history, parse_history, extend_history)
+
+
+UPDATES = [
+    ('NOVA', 'cores', 1), ('NOVA', 'instances', 1), ('NOVA', 'ram', 1024),
+    ('CINDER', 'gigabytes', 100), ('CINDER', 'volumes', 1),
+    ('SWIFT', 'bytes', 2**30), ('NEUTRON', 'floatingip', 1),
+]
+
+
+def update_lines(date):
+    curdate = date.strftime('(%Y-%m-%d %H:%M)')
+    lines = ['%s user%d updated quota' % (curdate, random.randrange(100)),
+             '%s Requested by the project owner' % curdate]
+    for service, key, unit in random.sample(UPDATES, 3):
+        old = random.randrange(1, 100) * unit
+        lines.append('%s %s: Update %s %d -> %d' % (
+            curdate, service, key, old, old + unit * random.randrange(1, 10)))
+    return lines
+
+
+def make_history(nlines):
+    date = datetime(2012, 1, 1)
+    lines = []
+    while len(lines) < nlines:
+        lines.extend(update_lines(date))
+        date += timedelta(hours=random.randrange(1, 72))
+    return '\n'.join(lines), date
+
+
+def timeit(func, *args, repeat=5):
+    """Return the best time out of `repeat` calls of `func`, and its result.
+
+    `func` returns the time spent in the part being measured and its
+    result; the cache is emptied before every call.
+    """
+    best = None
+    for _ in range(repeat):
+        _history_cache.invalidate()
+        elapsed, result = func(*args)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def full(text, history):
+    start = time.perf_counter()
+    result = _parse_history((text + '\n' + history).splitlines(), OrderedDict())
+    return time.perf_counter() - start, result
+
+
+def memoized(text, history):
+    newtext = text + '\n' + history
+    parse_history(newtext)
+    start = time.perf_counter()
+    result = parse_history(newtext)
+    return time.perf_counter() - start, result
+
+
+def incremental(text, history):
+    parse_history(text)
+    start = time.perf_counter()
+    result = parse_history(extend_history(text, history))
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=20000,
+                        help='number of lines of the synthetic history'
+                        ' (default: %(default)s)')
+    args = parser.parse_args()
+
+    random.seed(0)
+    text, date = make_history(args.lines)
+    history = '\n'.join(update_lines(date))
+
+    t_full, r_full = timeit(full, text, history)
+    t_memo, r_memo = timeit(memoized, text, history)
+    t_incr, r_incr = timeit(incremental, text, history)
+    assert r_full == r_memo == r_incr
+
+    print('%10s %12s %12s %12s' % ('lines', 'full [s]', 'memoized [s]', 'append [s]'))
+    print('%10d %12.6f %12.6f %12.6f' % (
+        len(text.splitlines()), t_full, t_memo, t_incr))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""Benchmark the project/role-assignment join done by `Projects.list`.
+
+Compares the old per-project scan of all the role assignments with
+`roles_by_project`, on synthetic data. The naive join is quadratic, so
+by default it is only run on the smaller data sets.
+
+Usage: python benchmarks/bench_projects_list.py [--naive-max N]
+"""
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from scadmin.models.projects import roles_by_project
+
+
+SIZES = [(100, 1000), (1000, 10000), (10000, 100000)]
+
+
+def make_data(nprojects, nassignments, nroles=5):
+    projects = [SimpleNamespace(id='%032x' % i) for i in range(nprojects)]
+    rolenames = {'role%d' % i: 'name%d' % i for i in range(nroles)}
+    assignments = [
+        ('user%d' % random.randrange(nassignments // 4),
+         random.choice(projects).id,
+         random.choice(list(rolenames)))
+        for _ in range(nassignments)]
+    return projects, assignments, rolenames
+
+
+def naive(projects, assignments, rolenames):
+    return [[rolenames.get(rid) for uid, pid, rid in assignments
+             if pid == project.id]
+            for project in projects]
+
+
+def indexed(projects, assignments, rolenames):
+    byproject = roles_by_project(assignments, rolenames)
+    return [byproject.get(project.id, []) for project in projects]
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--naive-max', type=int, default=10**7,
+                        help='skip the naive join when projects x assignments'
+                        ' exceeds this value (default: %(default)s)')
+    args = parser.parse_args()
+
+    random.seed(0)
+    print('%10s %12s %12s %12s' % ('projects', 'assignments', 'naive [s]', 'indexed [s]'))
+    for nprojects, nassignments in SIZES:
+        data = make_data(nprojects, nassignments)
+        t_indexed, r_indexed = timeit(indexed, *data)
+        if nprojects * nassignments <= args.naive_max:
+            t_naive, r_naive = timeit(naive, *data)
+            assert r_naive == r_indexed
+            t_naive = '%12.4f' % t_naive
+        else:
+            t_naive = '%12s' % 'skipped'
+        print('%10d %12d %s %12.4f' % (nprojects, nassignments, t_naive, t_indexed))
+
+
+if __name__ == "__main__":
+    main()
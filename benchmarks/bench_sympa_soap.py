@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+"""Benchmark the SOAP backend of `scadmin.models.sympa.ML`.
+
+Starts the local stand-in server of `sympa_soap_server.py` and times
+adding, listing and removing synthetic addresses on all the lists.
+
+Usage: python benchmarks/bench_sympa_soap.py [--users N] [--lists N] [--delay S]
+"""
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from scadmin import app, config
+from scadmin.models.sympa import ML
+
+from sympa_soap_server import SympaState, serve
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--lists', type=int, default=2)
+    parser.add_argument('--delay', type=float, default=0.001,
+                        help='server delay per request (default: %(default)s)')
+    args = parser.parse_args()
+
+    lists = tuple('list%d' % i for i in range(args.lists))
+    state = SympaState(lists, {'admin@example.org': 'secret'}, args.delay)
+    server = serve(state)
+
+    config.SYMPA_BACKEND = 'soap'
+    config.SYMPA_SOAP_URL = 'http://%s:%d/sympasoap' % server.server_address
+    config.SYMPA_URL = config.SYMPA_SOAP_URL
+    config.SYMPA_USERNAME = 'admin@example.org'
+    config.SYMPA_PASSWORD = 'secret'
+    config.SYMPA_LISTS = lists
+    config.SYMPA_SIZE = args.users
+    config.SYMPA_EMAIL_MAPPINGS = []
+
+    users = ['user%d@example.org' % i for i in range(args.users)]
+    with app.test_request_context():
+        ml = ML()
+        ml.login()
+        print('%-8s %10s' % ('call', 'time [s]'))
+        t, (info, err) = timeit(ml.add, users)
+        assert not err and len(info) == len(users) * len(lists), err[:3]
+        print('%-8s %10.4f' % ('add', t))
+        t, subscribers = timeit(ml.list, False, True)
+        assert subscribers == sorted(users)
+        print('%-8s %10.4f' % ('list', t))
+        t, _ = timeit(ml.list)
+        print('%-8s %10.4f' % ('cached', t))
+        t, (info, err) = timeit(ml.remove, users)
+        assert not err and not any(state.lists.values()), err[:3]
+        print('%-8s %10.4f' % ('remove', t))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+"""Local stand-in for the Sympa SOAP server.
+
+Implements `login`, `review`, `add` and `del` on in-memory lists, with
+an optional delay per request to simulate the network. Used by
+`bench_sympa_soap.py`, and handy to try the 'soap' backend of
+`scadmin.models.sympa.ML`: set SYMPA_SOAP_URL to the printed address.
+
+Usage: python benchmarks/sympa_soap_server.py [--port N] [--delay S] [--lists cloud,...]
+"""
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+
+from scadmin.models.sympasoap import SOAP_ENV, SYMPA_NS
+
+
+class SympaState(object):
+    """Accounts, sessions and subscribers of the fake server"""
+
+    def __init__(self, lists=('cloud',), accounts=None, delay=0):
+        self.lists = {ml: set() for ml in lists}
+        self.accounts = accounts or {}
+        self.sessions = set()
+        self.delay = delay
+        self.lock = threading.Lock()
+
+
+class Fault(Exception):
+    pass
+
+
+def response(method, values=(), fault=None):
+    env = ET.Element('{%s}Envelope' % SOAP_ENV)
+    body = ET.SubElement(env, '{%s}Body' % SOAP_ENV)
+    if fault is not None:
+        el = ET.SubElement(body, '{%s}Fault' % SOAP_ENV)
+        ET.SubElement(el, 'faultcode').text = 'soap:Client'
+        ET.SubElement(el, 'faultstring').text = fault
+    else:
+        el = ET.SubElement(body, '{%s}%sResponse' % (SYMPA_NS, method))
+        result = ET.SubElement(el, 'return')
+        for value in values:
+            ET.SubElement(result, 'item').text = str(value)
+    return ET.tostring(env, encoding='utf-8')
+
+
+class SympaHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        state = self.state
+        if state.delay:
+            time.sleep(state.delay)
+        body = ET.fromstring(self.rfile.read(int(self.headers['Content-Length'])))
+        call = body.find('{%s}Body' % SOAP_ENV)[0]
+        method = call.tag.split('}')[-1]
+        params = {el.tag: el.text or '' for el in call}
+        cookie = None
+        status = 200
+        try:
+            if method == 'login':
+                if state.accounts.get(params.get('email')) != params.get('password'):
+                    raise Fault('Authentication failed')
+                cookie = uuid.uuid4().hex
+                with state.lock:
+                    state.sessions.add(cookie)
+                values = [cookie]
+            else:
+                values = self.dispatch(state, method, params)
+        except Fault as ex:
+            status = 500
+            payload = response(method, fault=str(ex))
+        else:
+            payload = response(method, values)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        if cookie:
+            self.send_header('Set-Cookie', 'sympa_session=%s; Path=/' % cookie)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def dispatch(self, state, method, params):
+        cookies = dict(c.strip().split('=', 1)
+                       for c in (self.headers.get('Cookie') or '').split(';') if '=' in c)
+        with state.lock:
+            if cookies.get('sympa_session') not in state.sessions:
+                raise Fault('Authentication required')
+            if params.get('list') not in state.lists:
+                raise Fault('Unknown list %s' % params.get('list'))
+            subscribers = state.lists[params['list']]
+            email = params.get('email', '').lower()
+            if method == 'review':
+                return sorted(subscribers)
+            elif method == 'add':
+                if email in subscribers:
+                    raise Fault('User %s already subscribed' % email)
+                subscribers.add(email)
+                return [1]
+            elif method == 'del':
+                if email not in subscribers:
+                    raise Fault('User %s not subscribed' % email)
+                subscribers.remove(email)
+                return [1]
+        raise Fault('Unknown method %s' % method)
+
+
+def serve(state, host='127.0.0.1', port=0):
+    """Start a server for `state` in a background thread and return it;
+    its URL is ``'http://%s:%d/sympasoap' % server.server_address``"""
+    handler = type('Handler', (SympaHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--delay', type=float, default=0,
+                        help='seconds to wait before answering each request')
+    parser.add_argument('--lists', default='cloud')
+    parser.add_argument('--user', default='admin@example.org')
+    parser.add_argument('--password', default='secret')
+    args = parser.parse_args()
+
+    state = SympaState(args.lists.split(','), {args.user: args.password}, args.delay)
+    server = serve(state, port=args.port)
+    print('Serving on http://%s:%d/sympasoap' % server.server_address)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
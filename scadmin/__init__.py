@@ -64,6 +64,8 @@ def top_nav():
     if 'admin' in session['auth']['roles'] or \
        'usermanager' in session['auth']['roles']:
         elements.append(ProjectCreation())
+        elements.append(nave.View('Quota overview', 'main.quota_overview'))
+        elements.append(nave.View('Bulk quota update', 'main.bulk_quota'))
         if config.USE_SYMPA:
             elements.append(nave.View('Check mailing list users', 'sympa.list_users'))
     elements += [UserElement(), nave.View('Logout', 'auth.logout')]
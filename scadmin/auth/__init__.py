@@ -25,19 +25,90 @@ __author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
 from flask import redirect, current_app as app, session, Blueprint, url_for, request, render_template, abort
 
 from functools import wraps
+from datetime import datetime, timezone
+import threading
+
+import requests
 
 from scadmin.exceptions import AuthenticationRequired
 from scadmin.forms import LoginForm
+from scadmin.cache import TTLCache
 from scadmin import config
 
 from keystoneauth1.identity import v3
 from keystoneauth1 import session as ksession
+from keystoneauth1.session import TCPKeepAliveAdapter
 from keystoneauth1.exceptions.http import Unauthorized, Forbidden
 from keystoneclient.v3 import client as keystone_client
 
 
 login_bp = Blueprint('auth', __name__)
 
+# (token, project_id, project_domain_id) -> content of session['auth']
+# for tokens already validated against keystone.
+_token_cache = TTLCache(maxsize=getattr(config, 'TOKEN_CACHE_SIZE', 1024))
+
+def _cache_token(auth, expires, *keys):
+    """Remember `auth` under `keys` until shortly before the token expires"""
+    ttl = getattr(config, 'TOKEN_CACHE_TTL', 300)
+    if expires is not None:
+        margin = getattr(config, 'TOKEN_CACHE_MARGIN', 60)
+        ttl = min(ttl, (expires - datetime.now(timezone.utc)).total_seconds() - margin)
+    if ttl <= 0:
+        return
+    for key in keys:
+        _token_cache.set(key, dict(auth), ttl=ttl)
+
+# (token, project_id, project_domain_id) -> keystoneauth session, so
+# that authenticated plugins are reused across models and requests.
+_session_pool = TTLCache(ttl=getattr(config, 'SESSION_POOL_TTL', 3600),
+                         maxsize=getattr(config, 'SESSION_POOL_SIZE', 256))
+
+# HTTP connection pool shared by all the keystoneauth sessions of this
+# worker, so that keep-alive connections survive across requests.
+_http = None
+_http_lock = threading.Lock()
+
+def _http_session():
+    global _http
+    with _http_lock:
+        if _http is None:
+            _http = requests.Session()
+            # By default, one connection per host for each of the
+            # threads that may share the pool
+            maxsize = getattr(config, 'HTTP_POOL_MAXSIZE', max(
+                getattr(config, 'QUOTA_OVERVIEW_CONCURRENCY', 20),
+                getattr(config, 'USERS_FETCH_CONCURRENCY', 8)))
+            adapter = TCPKeepAliveAdapter(pool_maxsize=maxsize)
+            _http.mount('https://', adapter)
+            _http.mount('http://', adapter)
+        return _http
+
+# Keystone session of the service account used by the background jobs
+_service = None
+_service_lock = threading.Lock()
+
+def service_session():
+    """Return a keystoneauth session of the service account
+    `config.SERVICE_USERNAME`, or None if it is not configured.
+
+    The session authenticates again by itself when its token expires.
+    """
+    global _service
+    username = getattr(config, 'SERVICE_USERNAME', None)
+    if not username:
+        return None
+    with _service_lock:
+        if _service is None:
+            auth = v3.Password(auth_url=config.os_auth_url,
+                               username=username,
+                               password=config.SERVICE_PASSWORD,
+                               user_domain_name=config.os_user_domain_name,
+                               project_name=config.SERVICE_PROJECT_NAME,
+                               project_domain_id=config.os_project_domain_id)
+            _service = ksession.Session(auth=auth, session=_http_session())
+        return _service
+
 def fill_session_data(sess):
     auth = session.get('auth', {})
     auth['token'] = sess.get_token()
@@ -64,7 +135,7 @@ def authenticate_with_password(username, password):
                        username=username,
                        password=password,
                        user_domain_name=config.os_user_domain_name)
-    sess = ksession.Session(auth=auth)
+    sess = ksession.Session(auth=auth, session=_http_session())
     keystone = keystone_client.Client(session=sess)
     projects = keystone.projects.list(user=sess.get_user_id())
     # pick one project at random
@@ -76,7 +147,7 @@ def authenticate_with_password(username, password):
                        project_domain_id=projects[0].domain_id)
     app.logger.info("Correctly authenticated as {}".format(username))
     # get new scoped token
-    sess = ksession.Session(auth=auth)
+    sess = ksession.Session(auth=auth, session=_http_session())
     fill_session_data(sess)
     app.logger.info("User {}: switching to tenant {}".format(username, sess.auth.project_id))
 
@@ -88,18 +159,36 @@ def get_session(project_id=None, project_domain_id=None):
     if not project_domain_id:
         project_domain_id = 'default'
 
-    auth = v3.Token(
-        auth_url=config.os_auth_url,
-        token=str(session['auth']['token']),
-        project_id=project_id,
-        project_domain_id=project_domain_id,
-    )
-    sess = ksession.Session(auth=auth)
+    key = (str(session['auth']['token']), project_id, project_domain_id)
+    sess = _session_pool.get(key)
+    if sess is None:
+        auth = v3.Token(
+            auth_url=config.os_auth_url,
+            token=key[0],
+            project_id=project_id,
+            project_domain_id=project_domain_id,
+        )
+        sess = ksession.Session(auth=auth, session=_http_session())
+        _session_pool.set(key, sess)
     return sess
 
 def authenticate_with_token(project_id=None, project_domain_id='default'):
+    key = (session['auth']['token'],
+           project_id or session['auth']['project_id'],
+           project_domain_id)
+    cached = _token_cache.get(key)
+    if cached:
+        session['auth'] = dict(cached)
+        return
+
     sess = get_session(project_id, project_domain_id)
     fill_session_data(sess)
+    auth = session['auth']
+    # Also cache the new scoped token, which is the one the next
+    # request will present.
+    newkey = (auth['token'], auth['project_id'], project_domain_id)
+    _cache_token(auth, sess.auth.auth_ref.expires, key, newkey)
+    _session_pool.set(newkey, sess)
     app.logger.info("User {} authenticated on tenant {} using token".format(session['auth']['user_id'], sess.auth.project_id))
 
 
@@ -146,6 +235,9 @@ def login():
 @login_bp.route('/logout')
 def logout():
     if 'auth' in session:
+        token = session['auth'].get('token')
+        _token_cache.invalidate(lambda key: key[0] == token)
+        _session_pool.invalidate(lambda key: key[0] == token)
         del session['auth']
     session.clear()
     return redirect(url_for('auth.login'))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from contextlib import contextmanager
+import fcntl
+import os
+import threading
+import time
+
+from flask import current_app as app
+
+from keystoneclient.v3 import client as keystone_client
+
+from scadmin.auth import service_session
+from scadmin import config
+
+
+class BackgroundValue(object):
+    """Process-wide value computed from keystone, refreshed in the
+    background and optionally shared by the worker processes.
+
+    Subclasses define:
+
+    * `name`, used in the log messages
+    * `path_setting`: name of the setting with the path of the file
+      sharing the value between workers; if it is not set, every worker
+      keeps its own value
+    * `interval_setting`: (name, default) of the setting with the
+      number of seconds between two refreshes
+    * `_read(path)` and `_write(path, value)`, to load and save the
+      value; `_write` must replace the file atomically
+    * `_refresh(keystone, max_age)`, computing a new value unless the
+      current one is younger than `max_age` (see `_refreshing`) and
+      returning True if it did
+
+    The value must have an `age()` method. If the service account
+    `config.SERVICE_USERNAME` is configured, `_schedule` starts a thread
+    refreshing the value every interval with the credentials of that
+    account; otherwise a request finding the value older than that
+    starts a single refresh in the background with its own keystone
+    client.
+
+    New values are computed while holding `_refreshing`, which lets
+    only one thread of one process compute at a time, and published
+    while holding `_publishing`, which subclasses should hold as little
+    as possible.
+    """
+
+    name = None
+    path_setting = None
+    interval_setting = (None, None)
+
+    def __init__(self):
+        self._value = None
+        self._file_id = None
+        # held while publishing a new value
+        self._lock = threading.Lock()
+        # held while computing a new value
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def path(self):
+        return getattr(config, self.path_setting, None)
+
+    @property
+    def interval(self):
+        return getattr(config, *self.interval_setting)
+
+    @property
+    def value(self):
+        if self.path:
+            self._load(self.path)
+        return self._value
+
+    def age(self):
+        value = self.value
+        if value is None:
+            return None
+        return value.age()
+
+    def _load(self, path):
+        """Read the shared file, if it changed since the last call"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        file_id = (st.st_ino, st.st_mtime_ns)
+        if file_id != self._file_id:
+            self._value = self._read(path)
+            self._file_id = file_id
+
+    def _publish(self, value):
+        """Replace the value; call while holding `_publishing`"""
+        if self.path:
+            self._write(self.path, value)
+            self._load(self.path)
+        else:
+            self._value = value
+
+    @contextmanager
+    def _file_lock(self, suffix, blocking=True):
+        """Lock the shared file against other processes.
+
+        Yields False if `blocking` is false and the lock is held by
+        another process.
+        """
+        path = self.path
+        if not path:
+            yield True
+            return
+        with open(path + suffix, 'a') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                acquired = True
+            except BlockingIOError:
+                acquired = False
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _refreshing(self, blocking=True):
+        """Let only one thread of one process compute a new value.
+
+        Yields False if `blocking` is false and another thread or
+        process is already computing it.
+        """
+        if not self._refresh_lock.acquire(blocking):
+            yield False
+            return
+        try:
+            with self._file_lock('.lock', blocking) as acquired:
+                yield acquired
+        finally:
+            self._refresh_lock.release()
+
+    @contextmanager
+    def _publishing(self):
+        with self._lock, self._file_lock('.publish.lock'):
+            yield
+
+    @staticmethod
+    def service_keystone():
+        """Keystone client of the service account, or None"""
+        sess = service_session()
+        return keystone_client.Client(session=sess) if sess else None
+
+    def _schedule(self, keystone):
+        """Start the background refresh, if needed"""
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if service_session() is not None:
+                target, args = self._run, ()
+            elif self.age() is not None and self.age() > self.interval:
+                target, args = self._refresh_once, (keystone,)
+            else:
+                return
+            args = (app._get_current_object(),) + args
+            self._thread = threading.Thread(target=target, args=args, daemon=True)
+            self._thread.start()
+
+    def _run(self, flask_app):
+        while True:
+            time.sleep(self.interval)
+            self._refresh_once(flask_app, self.service_keystone())
+
+    def _refresh_once(self, flask_app, keystone):
+        with flask_app.app_context():
+            try:
+                start = time.time()
+                if self._refresh(keystone, max_age=self.interval/2):
+                    flask_app.logger.info("%s refreshed in %.2fs",
+                                          self.name, time.time() - start)
+            except Exception as ex:
+                flask_app.logger.error("Error while refreshing the %s: %s",
+                                       self.name.lower(), ex)
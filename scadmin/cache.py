@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread-safe, process-wide dictionary whose entries expire.
+
+    Every entry lives at most `ttl` seconds (or the `ttl` passed to
+    `set`). If `maxsize` is given, the least recently used entries are
+    evicted when the cache is full.
+
+    >>> c = TTLCache(ttl=60, maxsize=2)
+    >>> c.set('a', 1); c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> 'b' in c, 'a' in c
+    (False, True)
+    >>> c.set('d', 4, ttl=0)
+    >>> c.get('d', 'expired')
+    'expired'
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def update(self, key, func):
+        """Replace the value of `key` with `func(value)` atomically,
+        keeping its expiry time.
+
+        Nothing is done if `key` is missing or expired.
+
+        >>> c = TTLCache(ttl=60)
+        >>> c.set('a', 1)
+        >>> expires = c._data['a'][0]
+        >>> c.update('a', lambda v: v + 1); c.get('a')
+        2
+        >>> c._data['a'][0] == expires
+        True
+        >>> c.update('b', lambda v: v + 1); 'b' in c
+        False
+        """
+        sentinel = object()
+        with self._lock:
+            value = self.get(key, sentinel)
+            if value is not sentinel:
+                self._data[key] = (self._data[key][0], func(value))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self.get(key, default)
+            self._data.pop(key, None)
+            return value
+
+    def invalidate(self, match=None):
+        """Remove all entries, or only those for which `match(key)` is true"""
+        with self._lock:
+            if match is None:
+                self._data.clear()
+            else:
+                for key in [k for k in self._data if match(k)]:
+                    del self._data[key]
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self):
+        return len(self._data)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(name="cache",
+                    optionflags=doctest.NORMALIZE_WHITESPACE)
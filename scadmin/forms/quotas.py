@@ -22,7 +22,7 @@
 __docformat__ = 'reStructuredText'
 __author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
 
-from wtforms import Form, StringField, IntegerField, SubmitField, validators, BooleanField
+from wtforms import Form, StringField, IntegerField, SubmitField, validators, BooleanField, RadioField, TextAreaField
 from flask_wtf import FlaskForm
 from scadmin import config
 from wtforms.widgets.core import HTMLString
@@ -126,3 +126,45 @@ class SetQuotaForm(FlaskForm):
         if field.data > form.n_port.data:
             raise validators.ValidationError(
                 "Nr. of instances should at most be as much as the number of network ports (%d)" % form.n_port.data)
+
+
+class BulkQuotaForm(FlaskForm):
+    projects = TextAreaField('Projects', description='Project names or ids, one per line')
+    faculty = StringField('Faculty', description='All enabled projects of this faculty')
+    institute = StringField('Institute', description='All enabled projects of this institute')
+    mode = RadioField('Mode', default='set', choices=[
+        ('set', 'Set quota to the values below'),
+        ('add', 'Add the values below to the current quota')])
+
+    c_instances = IntegerField('Nr. of Instances', [validators.Optional()])
+    c_cores = IntegerField('Nr. of vCores', [validators.Optional()])
+    c_ram = IntegerField('Max Ram (bytes)', [validators.Optional()])
+
+    n_port = IntegerField('Number of network ports', [validators.Optional()])
+    n_network = IntegerField('Number of networks', [validators.Optional()])
+    n_subnet = IntegerField('Number of subnets', [validators.Optional()])
+    n_security_group = IntegerField('Number of security groups', [validators.Optional()])
+    n_security_group_rule = IntegerField('Number of security group rules', [validators.Optional()])
+    n_floatingip = IntegerField('Number of floating IPs', [validators.Optional()])
+    n_router = IntegerField('Number of routers', [validators.Optional()])
+
+    v_gigabytes = IntegerField('Volumes: bytes', [validators.Optional()])
+    v_volumes = IntegerField('Number of volumes', [validators.Optional()])
+
+    s_bytes = IntegerField('Swift bytes', [validators.Optional()])
+
+    comment = StringField("Comment", [validators.DataRequired()])
+    force = BooleanField("Bypass RAM/vcores ratio validation")
+    dry_run = BooleanField("Dry run (only show the changes)", default=True)
+    submit = SubmitField('Apply quota')
+
+    def quota_values(self):
+        """Return a dictionary with the quota fields that were filled in"""
+        return {field.name: field.data for field in self
+                if field.name[:2] in ('c_', 'n_', 'v_', 's_') and field.data is not None}
+
+    def validate_projects(form, field):
+        if not ((field.data or '').strip() or (form.faculty.data or '').strip()
+                or (form.institute.data or '').strip()):
+            raise validators.ValidationError(
+                "Please give a list of projects, a faculty or an institute")
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+
+def _index_by(column, size):
+    """Return the permutation of the rows sorting `column`, and the
+    offsets of each value in it (CSR-style)"""
+    counts = array('I', [0]) * (size + 1)
+    for value in column:
+        counts[value + 1] += 1
+    for i in range(size):
+        counts[i + 1] += counts[i]
+    offsets = array('I', counts)
+    perm = array('I', [0]) * len(column)
+    for row, value in enumerate(column):
+        perm[counts[value]] = row
+        counts[value] += 1
+    return perm, offsets
+
+
+class AssignmentStore(object):
+    """Compact, read-only store of (user_id, project_id, role_id) role
+    assignments.
+
+    Ids are interned to small integers: `users`, `projects` and `roles`
+    are the sorted sequences of ids, and an id is represented by its
+    position there. Assignments are three integer columns sorted by
+    project, with the offsets of the rows of each project; two more
+    permutations index the rows by user and by role. Any sequence of
+    integers works as a column, so the store can also be backed by a
+    memory-mapped file (see `snapfile`).
+
+    Iterating the store yields (user_id, project_id, role_id) tuples.
+
+    >>> store = AssignmentStore.build([('u1', 'p1', 'member'),
+    ...                                ('u2', 'p1', 'admin'),
+    ...                                ('u1', 'p2', 'admin')])
+    >>> dict(store.members('p1'))
+    {'u1': ['member'], 'u2': ['admin']}
+    >>> dict(store.members('p3'))
+    {}
+    >>> store.projects_of('u1')
+    [('p1', 'member'), ('p2', 'admin')]
+    >>> store.projects_of('u3')
+    []
+    >>> store.without_project('p1')
+    [('u1', 'p2', 'admin')]
+    >>> len(store.without_project('p3'))
+    3
+    """
+
+    def __init__(self, users, projects, roles,
+                 user_col, project_col, role_col, project_offsets,
+                 user_perm, user_offsets, role_perm, role_offsets):
+        self.users = users
+        self.projects = projects
+        self.roles = roles
+        self.user_col = user_col
+        self.project_col = project_col
+        self.role_col = role_col
+        self.project_offsets = project_offsets
+        self.user_perm = user_perm
+        self.user_offsets = user_offsets
+        self.role_perm = role_perm
+        self.role_offsets = role_offsets
+
+    @classmethod
+    def build(cls, assignments):
+        """Build a store from an iterable of (user_id, project_id,
+        role_id) tuples"""
+        assignments = sorted(set(assignments), key=lambda a: (a[1], a[0], a[2]))
+        users = sorted({a[0] for a in assignments})
+        projects = sorted({a[1] for a in assignments})
+        roles = sorted({a[2] for a in assignments})
+        uidx = {uid: i for i, uid in enumerate(users)}
+        pidx = {pid: i for i, pid in enumerate(projects)}
+        ridx = {rid: i for i, rid in enumerate(roles)}
+
+        user_col = array('I', (uidx[a[0]] for a in assignments))
+        project_col = array('I', (pidx[a[1]] for a in assignments))
+        role_col = array('I', (ridx[a[2]] for a in assignments))
+        # rows are already sorted by project
+        project_offsets = _index_by(project_col, len(projects))[1]
+        user_perm, user_offsets = _index_by(user_col, len(users))
+        role_perm, role_offsets = _index_by(role_col, len(roles))
+        return cls(users, projects, roles,
+                   user_col, project_col, role_col, project_offsets,
+                   user_perm, user_offsets, role_perm, role_offsets)
+
+    @staticmethod
+    def _find(ids, key):
+        i = bisect_left(ids, key)
+        if i < len(ids) and ids[i] == key:
+            return i
+        return None
+
+    def __len__(self):
+        return len(self.user_col)
+
+    def __iter__(self):
+        users, projects, roles = self.users, self.projects, self.roles
+        for u, p, r in zip(self.user_col, self.project_col, self.role_col):
+            yield (users[u], projects[p], roles[r])
+
+    def members(self, project_id):
+        """Return a dictionary {user_id: [role_id, ...]} for project
+        `project_id`"""
+        members = defaultdict(list)
+        p = self._find(self.projects, project_id)
+        if p is not None:
+            for row in range(self.project_offsets[p], self.project_offsets[p+1]):
+                members[self.users[self.user_col[row]]].append(self.roles[self.role_col[row]])
+        return members
+
+    def project_roles(self, project_id):
+        """Return the list of role ids assigned on project `project_id`"""
+        p = self._find(self.projects, project_id)
+        if p is None:
+            return []
+        return [self.roles[self.role_col[row]]
+                for row in range(self.project_offsets[p], self.project_offsets[p+1])]
+
+    def projects_of(self, user_id):
+        """Return a list of (project_id, role_id) for user `user_id`"""
+        u = self._find(self.users, user_id)
+        if u is None:
+            return []
+        rows = self.user_perm[self.user_offsets[u]:self.user_offsets[u+1]]
+        return [(self.projects[self.project_col[row]], self.roles[self.role_col[row]])
+                for row in rows]
+
+    def users_with_role(self, role_id):
+        """Return a list of (user_id, project_id) with role `role_id`"""
+        r = self._find(self.roles, role_id)
+        if r is None:
+            return []
+        rows = self.role_perm[self.role_offsets[r]:self.role_offsets[r+1]]
+        return [(self.users[self.user_col[row]], self.projects[self.project_col[row]])
+                for row in rows]
+
+    def without_project(self, project_id):
+        """Return a list of the assignments on projects other than
+        `project_id`"""
+        p = self._find(self.projects, project_id)
+        if p is None:
+            return list(self)
+        start, end = self.project_offsets[p], self.project_offsets[p+1]
+        users, projects, roles = self.users, self.projects, self.roles
+        return [(users[self.user_col[row]], projects[self.project_col[row]], roles[self.role_col[row]])
+                for row in range(len(self)) if not start <= row < end]
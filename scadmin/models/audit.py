@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from contextlib import contextmanager
+import sqlite3
+import threading
+
+from scadmin import config
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS quota_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    service TEXT,
+    resource TEXT,
+    old INTEGER,
+    new INTEGER,
+    msg TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS quota_history_project
+    ON quota_history (project_id, date);
+CREATE INDEX IF NOT EXISTS quota_history_service
+    ON quota_history (service, date);
+CREATE TRIGGER IF NOT EXISTS quota_history_no_update
+    BEFORE UPDATE ON quota_history
+    BEGIN SELECT RAISE(ABORT, 'quota_history is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS quota_history_no_delete
+    BEFORE DELETE ON quota_history
+    BEGIN SELECT RAISE(ABORT, 'quota_history is append-only'); END;
+CREATE TABLE IF NOT EXISTS imported (
+    project_id TEXT PRIMARY KEY,
+    entries INTEGER NOT NULL
+);
+"""
+
+COLUMNS = ('date', 'service', 'resource', 'old', 'new', 'msg')
+
+
+class AuditStore(object):
+    """Append-only SQLite store of the quota history of the projects.
+
+    Every entry is a dictionary with keys `date`, `service`,
+    `resource`, `old`, `new` and `msg`: `msg` is the text of the
+    history line without the date, the other fields are None for
+    lines that are not quota updates.
+
+    The history that used to be kept in the `quota_history` attribute
+    of the project is imported once per project with `import_history`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def imported(self, project_id):
+        row = self._connect().execute(
+            'SELECT 1 FROM imported WHERE project_id = ?', (project_id,)).fetchone()
+        return row is not None
+
+    def import_history(self, project_id, entries):
+        """Import the old history of a project, unless already done.
+
+        Returns True if the entries were imported.
+        """
+        with self._transaction() as db:
+            if db.execute('SELECT 1 FROM imported WHERE project_id = ?',
+                          (project_id,)).fetchone():
+                return False
+            self._insert(db, project_id, entries)
+            db.execute('INSERT INTO imported (project_id, entries) VALUES (?, ?)',
+                       (project_id, len(entries)))
+        return True
+
+    def append(self, project_id, entries):
+        with self._transaction() as db:
+            self._insert(db, project_id, entries)
+
+    @staticmethod
+    def _insert(db, project_id, entries):
+        db.executemany(
+            'INSERT INTO quota_history (project_id, %s) VALUES (?, %s)' % (
+                ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+            [[project_id] + [entry.get(col) for col in COLUMNS] for entry in entries])
+
+    def entries(self, project_id=None, service=None, since=None):
+        """Return the entries matching the arguments, oldest first"""
+        where, args = [], []
+        for column, value in [('project_id', project_id), ('service', service)]:
+            if value is not None:
+                where.append('%s = ?' % column)
+                args.append(value)
+        if since is not None:
+            where.append('date >= ?')
+            args.append(since)
+        query = 'SELECT project_id, %s FROM quota_history' % ', '.join(COLUMNS)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        cursor = self._connect().execute(query + ' ORDER BY id', args)
+        return [dict(zip(('project_id',) + COLUMNS, row)) for row in cursor]
+
+    def lines(self, project_id):
+        """Return the history of a project as text lines"""
+        cursor = self._connect().execute(
+            'SELECT date, msg FROM quota_history WHERE project_id = ? ORDER BY id',
+            (project_id,))
+        return ['(%s) %s' % row for row in cursor]
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def audit_store():
+    """Return the `AuditStore` at `config.AUDIT_DB`, or None if not configured"""
+    path = getattr(config, 'AUDIT_DB', None)
+    if not path:
+        return None
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = AuditStore(path)
+        return _stores[path]
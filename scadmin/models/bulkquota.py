@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from datetime import datetime
+
+from flask import session, current_app as app
+
+from scadmin.models.projects import Project
+from scadmin.models.quota import Quota
+from scadmin import config
+from scadmin.utils import fan_out
+
+
+def select_projects(projects, names=(), faculty=None, institute=None):
+    """Return the projects in `projects` matching the arguments.
+
+    A project matches if its name or id is in `names`, or if it belongs
+    to `faculty` and `institute` (when given; case insensitive).
+    """
+    names = set(names)
+    selected = []
+    for project in projects:
+        if project.id in names or project.name in names:
+            selected.append(project)
+        elif (faculty or institute) and \
+             (not faculty or (getattr(project, 'faculty', None) or '').lower() == faculty.lower()) and \
+             (not institute or (getattr(project, 'institute', None) or '').lower() == institute.lower()):
+            selected.append(project)
+    return selected
+
+
+class BulkQuota(object):
+    """Apply the same quota change to several projects.
+
+    `values` is a dictionary in the format of `Quota.to_dict`. If
+    `delta` is true its values are added to the current quota of each
+    project, otherwise they replace it.
+
+    `validate` is called with the resulting quota of each project, in
+    the same format, and returns a list of error messages: projects
+    with errors are not updated.
+    """
+
+    def __init__(self, values, delta=False, validate=None, comment=''):
+        self.values = values
+        self.delta = delta
+        self.validate = validate or (lambda quota: [])
+        self.comment = comment
+
+    def plan(self, quota):
+        """Return the new quota of a project, the changes {key: (old,
+        new)} and a list of errors.
+
+        In delta mode, unlimited (negative) values are left as they are
+        and reported as errors.
+        """
+        current = {key: int(value) for key, value in quota.to_dict().items()}
+        new = dict(current)
+        errors = []
+        for key, value in self.values.items():
+            if key not in current or (key == 's_bytes' and not quota.has_swift()):
+                continue
+            if self.delta and current[key] < 0:
+                errors.append("%s is unlimited, not adding %s to it" % (key, value))
+                continue
+            new[key] = current[key] + value if self.delta else value
+        changes = {key: (current.get(key), value) for key, value in new.items()
+                   if value != current.get(key)}
+        return new, changes, errors
+
+    def run(self, projects, dry_run=True):
+        """Compute, and unless `dry_run` apply, the changes to `projects`.
+
+        Quota is read again from the services and written concurrently,
+        by at most `config.QUOTA_BULK_CONCURRENCY` threads. Returns a
+        list with a dictionary for each project, with keys `project`,
+        `changes`, `errors` and `applied`.
+        """
+        quotas = Quota.overview([p.id for p in projects], refresh=True)
+        results = [{'project': p, 'changes': {}, 'errors': [], 'applied': False}
+                   for p in projects]
+        calls = {}
+        for result in results:
+            quota = quotas[result['project'].id]
+            if quota.errors:
+                result['errors'].extend("Unable to get %s quota: %s" % (service, ex)
+                                        for service, ex in sorted(quota.errors.items()))
+                continue
+            new, result['changes'], result['errors'] = self.plan(quota)
+            result['errors'].extend(self.validate(new))
+            if result['changes'] and not result['errors'] and not dry_run:
+                calls[result['project'].id] = (lambda quota=quota, new=new:
+                                               self._apply(quota, new))
+
+        applied, errors = fan_out(
+            calls, max_workers=getattr(config, 'QUOTA_BULK_CONCURRENCY', 8))
+        for result in results:
+            project_id = result['project'].id
+            if project_id in errors:
+                result['errors'].append("Error while updating quota: %s" % errors[project_id])
+            elif project_id in applied:
+                update_errors = applied[project_id]
+                result['errors'].extend(update_errors)
+                result['applied'] = not update_errors
+        return results
+
+    def _apply(self, quota, new):
+        """Update the quota of a project and record it in its history.
+
+        Returns the errors of the services that could not be updated.
+        """
+        updated = quota.set(new)
+        errors = ["Error while updating %s quota: %s" % (service, ex)
+                  for service, ex in sorted(updated.errors.items())]
+        if updated:
+            curdate = datetime.now().strftime('(%Y-%m-%d %H:%M)')
+            history = ["%s %s updated quota" % (curdate, session['auth']['user_id'])]
+            if self.comment:
+                history.append("%s %s" % (curdate, self.comment))
+            for qtype, qvalue in updated.items():
+                for key, values in qvalue.items():
+                    history.append("%s %s: Update %s %s -> %s" % (
+                        curdate, qtype.upper(), key, values[0], values[1]))
+            Project(quota.project_id).add_to_history(str.join('\n', history))
+            app.logger.info("Project %s: bulk quota update: %s", quota.project_id,
+                            str.join(', ', [i[len(curdate)+1:] for i in history]))
+        return errors
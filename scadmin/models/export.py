@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import csv
+import io
+import json
+
+from scadmin.models.inventory import inventory
+from scadmin.models.projects import Projects
+from scadmin.models.quota import Quota
+from scadmin.models.roles import role_cache
+from scadmin import config
+
+
+PROJECT_FIELDS = ('id', 'name',
+                  'owner', 'owner_email',
+                  'contact', 'contact_email',
+                  's3it_owner', 's3it_owner_email',
+                  'faculty', 'institute')
+
+# Same keys as `Quota.to_dict` and `SetQuotaForm`
+QUOTA_FIELDS = ('c_instances', 'c_cores', 'c_ram',
+                'n_port', 'n_network', 'n_subnet', 'n_security_group',
+                'n_security_group_rule', 'n_floatingip', 'n_router',
+                'v_volumes', 'v_gigabytes',
+                's_bytes')
+
+
+def project_rows(with_quota=True):
+    """Yield a dictionary for each enabled project.
+
+    Projects and members come from the inventory. Quota is read by
+    `Quota.overview`, `config.EXPORT_CHUNK_SIZE` projects at a time, so
+    only the rows of one chunk are kept in memory.
+    """
+    projects = Projects()
+    snapshot = inventory.get(projects.keystone)
+    rolenames = role_cache.names(projects.keystone, snapshot.assignments.roles)
+    enabled = projects.enabled()
+    size = getattr(config, 'EXPORT_CHUNK_SIZE', 50)
+    for start in range(0, len(enabled), size):
+        chunk = enabled[start:start+size]
+        quotas = Quota.overview([p.id for p in chunk]) if with_quota else {}
+        for project in chunk:
+            row = {field: getattr(project, field, None) for field in PROJECT_FIELDS}
+            row['members'] = []
+            for uid, rids in sorted(snapshot.assignments.members(project.id).items()):
+                user = snapshot.users.get(uid)
+                row['members'].append({
+                    'id': uid,
+                    'email': getattr(user, 'email', None),
+                    'roles': sorted(rolenames.get(rid, rid) for rid in rids),
+                })
+            if with_quota:
+                quota = quotas[project.id]
+                row['quota'] = quota.to_dict()
+                row['errors'] = sorted(quota.errors)
+            yield row
+
+
+def to_ndjson(rows):
+    """Yield `rows` as lines of JSON"""
+    for row in rows:
+        yield json.dumps(row, default=str) + '\n'
+
+
+def to_csv(rows, with_quota=True):
+    """Yield `rows` as CSV lines, starting with the header.
+
+    Members are written in a single column as
+    ``email-or-id:role+role;...``.
+    """
+    columns = list(PROJECT_FIELDS) + ['members']
+    if with_quota:
+        columns += list(QUOTA_FIELDS) + ['errors']
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    def line(values):
+        writer.writerow(values)
+        text = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return text
+
+    yield line(columns)
+    for row in rows:
+        values = [row[field] for field in PROJECT_FIELDS]
+        values.append(str.join(';', ['%s:%s' % (m['email'] or m['id'], str.join('+', m['roles']))
+                                     for m in row['members']]))
+        if with_quota:
+            values += [row['quota'].get(key) for key in QUOTA_FIELDS]
+            values.append(str.join(' ', row['errors']))
+        yield line(values)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import time
+
+from flask import session, current_app as app
+
+from scadmin.background import BackgroundValue
+from scadmin.models.users import assignment_tuples, fetch_users
+from scadmin.models.assignments import AssignmentStore
+from scadmin.models import snapfile
+from scadmin import config
+
+
+class Snapshot(object):
+    """Copy of the keystone data listed by most of the views.
+
+    * `projects`: dictionary {project_id: project}, including disabled
+      projects
+    * `assignments`: `AssignmentStore` of the role assignments of users
+      on projects. A list of (user_id, project_id, role_id) tuples is
+      converted automatically
+    * `users`: dictionary {user_id: user} of the users in `assignments`
+      belonging to the default domain
+    * `timestamp`: when the data was fetched
+    """
+
+    def __init__(self, projects, assignments, users, timestamp=None):
+        self.projects = projects
+        if not isinstance(assignments, AssignmentStore):
+            assignments = AssignmentStore.build(assignments)
+        self.assignments = assignments
+        self.users = users
+        self.timestamp = timestamp or time.time()
+
+    def age(self):
+        return time.time() - self.timestamp
+
+
+class Inventory(BackgroundValue):
+    """Process-wide, periodically refreshed `Snapshot`.
+
+    The first call to `get` fetches the data, which is then refreshed
+    every `config.INVENTORY_REFRESH_INTERVAL` seconds as described in
+    `BackgroundValue`.
+
+    A refresh lists projects and role assignments again, but only
+    fetches users that were not known yet; all users are fetched again
+    every `config.INVENTORY_FULL_REFRESH_INTERVAL` seconds. Local writes call
+    `refresh_project` to update the data of a single project right away.
+
+    Data is fetched without holding the lock that protects the
+    snapshot, which is only taken to publish the new one: a
+    `refresh_project` never waits for a whole refresh, and the projects
+    it updated while a refresh was running are not overwritten by the
+    older data of that refresh.
+
+    If `config.INVENTORY_SNAPSHOT_PATH` is set, the snapshot is shared
+    by all the worker processes through a memory-mapped file (see
+    `snapfile`): refreshes are serialized with a lock file, only one
+    worker per interval fetches the data, and the others just map the
+    new file.
+    """
+
+    name = 'Inventory'
+    path_setting = 'INVENTORY_SNAPSHOT_PATH'
+    interval_setting = ('INVENTORY_REFRESH_INTERVAL', 300)
+
+    def __init__(self):
+        BackgroundValue.__init__(self)
+        self._full_timestamp = 0
+        # users referenced by assignments but not in the default domain
+        self._ignored = set()
+        # project_id -> when its last `refresh_project` started
+        self._touched = {}
+
+    @staticmethod
+    def usable():
+        """True if the current user is allowed to see the whole inventory"""
+        return bool(set(session['auth']['roles']).intersection(['admin', 'usermanager']))
+
+    @property
+    def snapshot(self):
+        return self.value
+
+    @staticmethod
+    def _read(path):
+        return snapfile.MappedSnapshot(path)
+
+    @staticmethod
+    def _write(path, snapshot):
+        snapfile.write(path, snapshot)
+
+    def get(self, keystone):
+        """Return the current snapshot, fetching it if there is none yet"""
+        if self.snapshot is None:
+            # another thread or worker might be fetching it already
+            self.refresh(self.service_keystone() or keystone, max_age=self.interval)
+        self._schedule(keystone)
+        return self.snapshot
+
+    def _refresh(self, keystone, max_age):
+        return self.refresh(keystone, max_age=max_age, blocking=False)
+
+    def refresh(self, keystone, max_age=None, blocking=True):
+        """Fetch a new snapshot.
+
+        Nothing is done if the current snapshot is younger than
+        `max_age` seconds, or if `blocking` is false and another thread
+        or process is already refreshing it. Returns True if the
+        snapshot was refreshed.
+        """
+        with self._refreshing(blocking) as acquired:
+            if not acquired:
+                return False
+            old = self.snapshot
+            if max_age is not None and old is not None and old.age() < max_age:
+                return False
+            start = time.time()
+            projects = {p.id: p for p in keystone.projects.list()}
+            assignments = assignment_tuples(keystone.role_assignments.list())
+
+            full_interval = getattr(config, 'INVENTORY_FULL_REFRESH_INTERVAL', 3600)
+            if old is None or start - self._full_timestamp > full_interval:
+                uids = {a[0] for a in assignments}
+                users = fetch_users(keystone, uids)
+                self._ignored = uids.difference(users)
+                self._full_timestamp = start
+            else:
+                users = self._update_users(keystone, old.users, assignments)
+
+            with self._publishing():
+                current = self.snapshot
+                touched = [pid for pid, when in self._touched.items() if when >= start]
+                if current is not None and touched:
+                    # updated by `refresh_project` after we started
+                    assignments = [a for a in assignments if a[1] not in touched]
+                    for project_id in touched:
+                        if project_id in current.projects:
+                            projects[project_id] = current.projects[project_id]
+                        for uid, rids in current.assignments.members(project_id).items():
+                            assignments.extend((uid, project_id, rid) for rid in rids)
+                            if uid in current.users:
+                                users[uid] = current.users[uid]
+                self._touched = {pid: when for pid, when in self._touched.items()
+                                 if when >= start}
+                self._publish(Snapshot(projects, assignments, users, start))
+            return True
+
+    def refresh_project(self, keystone, project_id):
+        """Update project `project_id` and its role assignments.
+
+        Errors are logged and otherwise ignored, as the next scheduled
+        refresh will fix the snapshot anyway.
+        """
+        try:
+            self._refresh_project(keystone, project_id)
+        except Exception as ex:
+            app.logger.error("Error while refreshing project %s in the inventory: %s",
+                             project_id, ex)
+
+    def _refresh_project(self, keystone, project_id):
+        old = self.snapshot
+        if old is None:
+            return
+        start = time.time()
+        project = keystone.projects.get(project_id)
+        fetched = assignment_tuples(keystone.role_assignments.list(project=project_id))
+        new_users = self._fetch_new_users(keystone, old.users, {a[0] for a in fetched})
+
+        with self._publishing():
+            old = self.snapshot
+            self._touched[project_id] = max(start, self._touched.get(project_id, 0))
+            projects = dict(old.projects.items())
+            projects[project_id] = project
+            assignments = old.assignments.without_project(project_id)
+            assignments.extend(fetched)
+            uids = {a[0] for a in assignments}
+            users = {uid: user for uid, user in old.users.items() if uid in uids}
+            users.update((uid, user) for uid, user in new_users.items() if uid in uids)
+            # The rest of the data is still as old as before
+            self._publish(Snapshot(projects, assignments, users, old.timestamp))
+
+    def _fetch_new_users(self, keystone, known, uids):
+        """Fetch the users in `uids` not in `known` nor ignored"""
+        missing = set(uids).difference(known, self._ignored)
+        if not missing:
+            return {}
+        fetched = fetch_users(keystone, missing)
+        self._ignored.update(missing.difference(fetched))
+        return fetched
+
+    def _update_users(self, keystone, known, assignments):
+        uids = {a[0] for a in assignments}
+        users = {uid: user for uid, user in known.items() if uid in uids}
+        users.update(self._fetch_new_users(keystone, known, uids))
+        return users
+
+
+inventory = Inventory()
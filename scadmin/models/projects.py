@@ -24,10 +24,16 @@ __author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
 
 from flask import session, current_app as app
 from collections import defaultdict, OrderedDict
+import hashlib
 import re
 
 from scadmin.auth import get_session
+from scadmin.cache import TTLCache
 from scadmin.exceptions import InsufficientAuthorization
+from scadmin.models.roles import role_cache
+from scadmin.models.audit import audit_store
+from scadmin.models.inventory import inventory
+from scadmin.models.users import assignment_tuples
 from scadmin import config
 from scadmin.utils import to_bib
 
@@ -39,6 +45,209 @@ from neutronclient.v2_0 import client as neutron_client
 from neutronclient.common.exceptions import Conflict
 
 
+remsg = re.compile('\((?P<date>[0-9]{4}-[0-9]{2}-[0-9]{2}(\s*[0-9]{2}:[0-9]{2})?)\) *(?P<msg>.*)')
+requotaline = re.compile('(?P<service>NEUTRON|SWIFT|CINDER[^:]*|NOVA): (?P<update>.*)')
+requota = re.compile('((?P<type>[^:]+): )?(?P<new>[+-]*[0-9]+) *(?P<unit>GiB|TiB)? *\((?P<delta>[+-][0-9]+) *(?P<oldunit>GiB|TiB)?\)')
+requota2 = re.compile('Update (?P<type>[^:]+) (?P<old>[0-9]+) -> (?P<new>[0-9]+)')
+
+# Written in the `quota_history` attribute, before the last update, once
+# the history of a project was imported in the audit store
+HISTORY_POINTER = 'Full quota history is kept in the dashboard audit store.'
+
+_history_cache = TTLCache(maxsize=getattr(config, 'HISTORY_CACHE_SIZE', 256))
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _parse_history(lines, quota_history, shared=()):
+    """Parse quota history `lines` into the `quota_history` dictionary.
+
+    Dates listed in `shared` belong to a dictionary that is also
+    referenced elsewhere: their entries are copied before being
+    modified.
+    """
+    shared = set(shared)
+    for line in lines:
+        if not remsg.match(line):
+            continue
+        m = remsg.search(line)
+        date = m.group('date')
+        msg = m.group('msg')
+        if date not in quota_history:
+            quota_history[date] = {'msg': '', 'services': []}
+        elif date in shared:
+            # Entry still belongs to a memoized result: copy it first.
+            entry = quota_history[date]
+            quota_history[date] = {'msg': entry['msg'],
+                                   'services': list(entry['services'])}
+            shared.discard(date)
+
+        curdata = quota_history[date]['services']
+
+        m = requotaline.match(msg)
+        if not m and msg:
+            if quota_history[date]['msg']:
+                quota_history[date]['msg'] += ('\n%s' % msg)
+            else:
+                quota_history[date]['msg'] = msg
+            continue
+        service = m.group('service')
+        d = OrderedDict()
+        curdata.append((service, d))
+        for update in m.group('update').split(','):
+            u = requota.search(update.strip())
+            if not u:
+                continue
+            new, delta = int(u.group('new')), int(u.group('delta'))
+            old = new - delta
+            oldunit = u.group('unit')
+            newunit = oldunit
+            if newunit is None:
+                newunit = oldunit = ''
+
+            typ = u.group('type')
+            if typ in ['ram', 'bytes', 'gigabytes', 'gigabytes_vhp']:
+                if typ == 'ram':
+                    old *= 2**20
+                    new *= 2**20
+                elif typ.startswith('gigabytes'):
+                    old *= 2**30
+                    new *= 2**30
+                if not newunit:
+                    old, oldunit = to_bib(old)
+                    new, newunit = to_bib(new)
+            if not typ:
+                typ = 'default'
+            if typ in d:
+                typidx = 1
+                while '%s %d' % (typ, typidx) in d:
+                    typidx += 1
+                # This usually measn that there were two quota updates in the same day.
+                typ = "%s (%d)" % (typ, typidx)
+            d[typ] = (old, new, oldunit, newunit)
+        # Also check if the quota history line matches the new regexp
+        u = requota2.search(m.group('update'))
+        if u:
+            # Note: these values are absolute, so we might want to
+            # convert them to human-readable.
+            old, new = int(u.group('old')), int(u.group('new'))
+            oldunit = newunit = ''
+            typ = u.group('type')
+            if typ in ['ram', 'bytes', 'gigabytes', 'gigabytes_vhp']:
+                if typ == 'ram':
+                    old *= 2**20
+                    new *= 2**20
+                elif typ.startswith('gigabytes'):
+                    old *= 2**30
+                    new *= 2**30
+                old, oldunit = to_bib(old)
+                new, newunit = to_bib(new)
+            d[typ] = (old, new, oldunit, newunit)
+
+    return quota_history
+
+
+def parse_history(text):
+    """Parse the `quota_history` attribute of a project.
+
+    Results are memoized on the digest of `text`: callers must not
+    modify the returned dictionary.
+    """
+    key = _digest(text)
+    quota_history = _history_cache.get(key)
+    if quota_history is None:
+        quota_history = _parse_history(text.splitlines(), OrderedDict())
+        _history_cache.set(key, quota_history)
+    return quota_history
+
+
+def extend_history(text, history):
+    """Append `history` to the quota history `text` and return the new text.
+
+    If `text` was already parsed, only the lines of `history` are
+    parsed and the result is memoized for the new text.
+    """
+    newtext = text + '\n' + history
+    old = _history_cache.get(_digest(text))
+    if old is not None:
+        _history_cache.set(
+            _digest(newtext),
+            _parse_history(history.splitlines(), OrderedDict(old), shared=old))
+    return newtext
+
+
+def history_entries(lines):
+    """Convert quota history `lines` to `AuditStore` entries.
+
+    Lines without a date are skipped, as `parse_history` does.
+    """
+    entries = []
+    for line in lines:
+        m = remsg.match(line)
+        if not m:
+            continue
+        entry = {'date': m.group('date'), 'msg': m.group('msg')}
+        q = requotaline.match(entry['msg'])
+        if q:
+            entry['service'] = q.group('service')
+            u = requota2.search(q.group('update'))
+            if u:
+                entry['resource'] = u.group('type')
+                entry['old'], entry['new'] = int(u.group('old')), int(u.group('new'))
+        entries.append(entry)
+    return entries
+
+
+def roles_by_project(assignments, rolenames):
+    """Group role assignments by project.
+
+    `assignments` is a list of (user_id, project_id, role_id) tuples.
+    Returns a dictionary {project_id: [role_name, ...]} built in a
+    single pass over `assignments`.
+    """
+    byproject = defaultdict(list)
+    for uid, pid, rid in assignments:
+        byproject[pid].append(rolenames.get(rid))
+    return byproject
+
+
+# Columns of the project list that can be filtered and sorted
+PROJECT_COLUMNS = ('name', 'owner', 'contact', 's3it_owner', 'faculty', 'institute', 'roles')
+
+def _column(item, column):
+    if column == 'roles':
+        return str.join(', ', sorted(r for r in item.get('roles', []) if r))
+    return getattr(item['p'], column, None) or ''
+
+def page_projects(plist, search='', filters=None, order=(('name', 'asc'),), start=0, length=None):
+    """Filter, sort and paginate `plist`, as returned by `Projects.list`.
+
+    `search` must appear in one of the `PROJECT_COLUMNS`, and
+    `filters` is a dictionary {column: text} of case insensitive
+    substrings that must appear in the corresponding column. `order`
+    is a list of (column, 'asc' or 'desc').
+
+    Returns the number of items after filtering and the requested page.
+    """
+    search = search.lower()
+    filters = {column: text.lower() for column, text in (filters or {}).items()
+               if column in PROJECT_COLUMNS and text}
+    if search or filters:
+        plist = [item for item in plist
+                 if all(text in _column(item, column).lower() for column, text in filters.items())
+                 and (not search or any(search in _column(item, column).lower()
+                                        for column in PROJECT_COLUMNS))]
+    # Sort on the least significant column first
+    for column, direction in reversed(list(order)):
+        if column in PROJECT_COLUMNS:
+            plist = sorted(plist, key=lambda item: _column(item, column).lower(),
+                           reverse=direction == 'desc')
+    end = None if length is None or length < 0 else start + length
+    return len(plist), plist[start:end]
+
+
 class Project(object):
     def __init__(self, name_or_id=None):
         self.session = get_session()
@@ -76,40 +285,61 @@ class Project(object):
 
     def members(self):
         try:
-            roles = {r.id: r.name for r in self.keystone.roles.list()}
-            assignments = self.keystone.role_assignments.list(project=self.project.id)
+            if inventory.usable():
+                assignments = inventory.get(self.keystone).assignments.members(self.project.id)
+            else:
+                assignments = defaultdict(list)
+                for uid, pid, rid in assignment_tuples(
+                        self.keystone.role_assignments.list(project=self.project.id)):
+                    assignments[uid].append(rid)
+
+            users = defaultdict(list)
+            for uid, rids in assignments.items():
+                users[uid].extend(role_cache.name(self.keystone, rid) for rid in rids)
         except Forbidden:
             raise InsufficientAuthorization
-
-        users = defaultdict(list)
-        for a in assignments:
-            users[a.user['id']].append(roles[a.role['id']])
         return users
 
     def grant(self, username, rolename):
         try:
-            role = self.keystone.roles.find(name=rolename)
+            role = role_cache.id(self.keystone, rolename)
             self.keystone.roles.grant(role, user=username, project=self.project)
         except Forbidden:
             raise InsufficientAuthorization
+        inventory.refresh_project(self.keystone, self.project.id)
 
 
     def revoke(self, username, rolename):
         try:
-            role = self.keystone.roles.find(name=rolename)
+            role = role_cache.id(self.keystone, rolename)
             self.keystone.roles.revoke(role, user=username, project=self.project)
         except Forbidden:
             raise InsufficientAuthorization
+        inventory.refresh_project(self.keystone, self.project.id)
 
 
     def add_to_history(self, history):
-        try:
-            newhistory = self.project.quota_history.strip() + '\n' + history
-        except AttributeError:
-            newhistory = history
+        store = audit_store()
+        if store:
+            self._import_history(store)
+            store.append(self.project.id, history_entries(history.splitlines()))
+            # The store now has the whole history: only keep the last
+            # update in keystone
+            newhistory = str.join('\n', [HISTORY_POINTER, history])
+        else:
+            try:
+                newhistory = extend_history(self.project.quota_history.strip(), history)
+            except AttributeError:
+                newhistory = history
 
         self.keystone.projects.update(self.project, quota_history=newhistory)
         self.project.quota_history = newhistory
+        inventory.refresh_project(self.keystone, self.project.id)
+
+    def _import_history(self, store):
+        if not store.imported(self.project.id):
+            text = getattr(self.project, 'quota_history', '')
+            store.import_history(self.project.id, history_entries(text.splitlines()))
 
     def history(self):
         """Returns an ordered dictionary {
@@ -118,85 +348,11 @@ class Project(object):
                            '<service>': {'<type>': (<old>, <new>, <oldunit>, <newunit>)}}
                       },
         }"""
-        quota_history = OrderedDict()
-        remsg = re.compile('\((?P<date>[0-9]{4}-[0-9]{2}-[0-9]{2}(\s*[0-9]{2}:[0-9]{2})?)\) *(?P<msg>.*)')
-        requotaline = re.compile('(?P<service>NEUTRON|SWIFT|CINDER[^:]*|NOVA): (?P<update>.*)')
-        requota = re.compile('((?P<type>[^:]+): )?(?P<new>[+-]*[0-9]+) *(?P<unit>GiB|TiB)? *\((?P<delta>[+-][0-9]+) *(?P<oldunit>GiB|TiB)?\)')
-        requota2 = re.compile('Update (?P<type>[^:]+) (?P<old>[0-9]+) -> (?P<new>[0-9]+)')
-
-
-        for line in self.quota_history.splitlines():
-            if not remsg.match(line):
-                continue
-            m = remsg.search(line)
-            date = m.group('date')
-            msg = m.group('msg')
-            if date not in quota_history:
-                quota_history[date] = {'msg': '', 'services': []}
-
-            curdata = quota_history[date]['services']
-
-            m = requotaline.match(msg)
-            if not m and msg:
-                if quota_history[date]['msg']:
-                    quota_history[date]['msg'] += ('\n%s' % msg)
-                else:
-                    quota_history[date]['msg'] = msg
-                continue
-            service = m.group('service')
-            d = OrderedDict()
-            curdata.append((service, d))
-            for update in m.group('update').split(','):
-                u = requota.search(update.strip())
-                if not u:
-                    continue
-                new, delta = int(u.group('new')), int(u.group('delta'))
-                old = new - delta
-                oldunit = u.group('unit')
-                newunit = oldunit
-                if newunit is None:
-                    newunit = oldunit = ''
-
-                typ = u.group('type')
-                if typ in ['ram', 'bytes', 'gigabytes', 'gigabytes_vhp']:
-                    if typ == 'ram':
-                        old *= 2**20
-                        new *= 2**20
-                    elif typ.startswith('gigabytes'):
-                        old *= 2**30
-                        new *= 2**30
-                    if not newunit:
-                        old, oldunit = to_bib(old)
-                        new, newunit = to_bib(new)
-                if not typ:
-                    typ = 'default'
-                if typ in d:
-                    typidx = 1
-                    while '%s %d' % (typ, typidx) in d:
-                        typidx += 1
-                    # This usually measn that there were two quota updates in the same day.
-                    typ = "%s (%d)" % (typ, typidx)
-                d[typ] = (old, new, oldunit, newunit)
-            # Also check if the quota history line matches the new regexp
-            u = requota2.search(m.group('update'))
-            if u:
-                # Note: these values are absolute, so we might want to
-                # convert them to human-readable.
-                old, new = int(u.group('old')), int(u.group('new'))
-                oldunit = newunit = ''
-                typ = u.group('type')
-                if typ in ['ram', 'bytes', 'gigabytes', 'gigabytes_vhp']:
-                    if typ == 'ram':
-                        old *= 2**20
-                        new *= 2**20
-                    elif typ.startswith('gigabytes'):
-                        old *= 2**30
-                        new *= 2**30
-                    old, oldunit = to_bib(old)
-                    new, newunit = to_bib(new)
-                d[typ] = (old, new, oldunit, newunit)
-
-        return quota_history
+        store = audit_store()
+        if store:
+            self._import_history(store)
+            return parse_history(str.join('\n', store.lines(self.project.id)))
+        return parse_history(self.quota_history)
 
 class Projects(object):
     def __init__(self):
@@ -210,21 +366,33 @@ class Projects(object):
         self.name = self.project.name
 
 
+    def enabled(self):
+        """Return all the enabled projects, from the inventory"""
+        snapshot = inventory.get(self.keystone)
+        return sorted((p for p in snapshot.projects.values() if p.enabled),
+                      key=lambda p: p.name)
+
     def list(self):
         plist = []
 
         # FIXME!!! Hardcoding the role meaning!
 
         if 'admin' in session['auth']['roles'] or 'usermanager' in session['auth']['roles']:
-            projects = self.keystone.projects.list(enabled=True)
-            rolenames = {r.id: r.name for r in self.keystone.roles.list()}
-            roles = self.keystone.role_assignments.list()
-            myroles = self.keystone.role_assignments.list(user=self.session.get_user_id())
+            snapshot = inventory.get(self.keystone)
+            projects = [p for p in snapshot.projects.values() if p.enabled]
+            store = snapshot.assignments
+            rolenames = role_cache.names(self.keystone, store.roles)
+            byproject = {p.id: [rolenames.get(rid) for rid in store.project_roles(p.id)]
+                         for p in projects}
+            userid = self.session.get_user_id()
+            mybyproject = roles_by_project(
+                [(userid, pid, rid) for pid, rid in store.projects_of(userid)], rolenames)
         elif 'project_admin' in session['auth']['roles']:
             projects = self.keystone.projects.list(user=self.session.get_user_id(), enabled=True)
-            rolenames = {r.id: r.name for r in self.keystone.roles.list()}
-            myroles = self.keystone.role_assignments.list(user=self.session.get_user_id())
-            roles = myroles
+            myroles = assignment_tuples(
+                self.keystone.role_assignments.list(user=self.session.get_user_id()))
+            rolenames = role_cache.names(self.keystone, {a[2] for a in myroles})
+            byproject = mybyproject = roles_by_project(myroles, rolenames)
         else:
             projects = self.keystone.projects.list(user=self.session.get_user_id(), enabled=True)
 
@@ -233,8 +401,8 @@ class Projects(object):
             for project in projects:
                 plist.append({
                     'p': project,
-                    'roles': [rolenames.get(r.role['id']) for r in roles if r.scope['project']['id'] == project.id],
-                    'myroles': [rolenames.get(r.role['id']) for r in myroles if r.scope['project']['id'] == project.id],
+                    'roles': byproject.get(project.id, []),
+                    'myroles': mybyproject.get(project.id, []),
                 })
         else:
             # Regular member
@@ -268,4 +436,5 @@ class Projects(object):
         })
         # all done, enable project
         self.keystone.projects.update(project, enabled=True)
+        inventory.refresh_project(self.keystone, project.id)
         return project
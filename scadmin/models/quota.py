@@ -23,69 +23,302 @@ __docformat__ = 'reStructuredText'
 __author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
 
 from flask import session
-from collections import defaultdict
+from collections import OrderedDict
+from functools import partial
 
 from scadmin.auth import get_session
+from scadmin.cache import TTLCache
 from scadmin.exceptions import InsufficientAuthorization
 from scadmin import config
-from flask import current_app as app
+from scadmin.utils import fan_out, RateLimiter
+from flask import current_app as app, has_request_context
 
 from keystoneclient.v3 import client as keystone_client
+from keystoneauth1.exceptions.http import NotFound
 from novaclient.client import Client as nova_client
 from cinderclient import client as cinder_client
 from neutronclient.v2_0 import client as neutron_client
+from neutronclient.common import exceptions as neutron_exceptions
 import swiftclient
 
-class Quota:
-    def __init__(self, project_id):
-        self.project_id = project_id
-        self.session = get_session()
+# project_id -> (quota, usage, storage_url), as last read or
+# acknowledged by the services. Lets the quota view re-render right after an update
+# without reading everything again. The caches below are only read and
+# filled by privileged users (see `_shared_cache`), as other users might
+# not be allowed to read the quota of every project.
+_quota_cache = TTLCache(ttl=getattr(config, 'QUOTA_CACHE_TTL', 60),
+                        maxsize=getattr(config, 'QUOTA_CACHE_SIZE', 1024))
+
+# Public object-store endpoint (with a `%(tenant_id)s` placeholder), or
+# None if there is no swift, and whether neutron has the `quota_details`
+# extension. They only change when the cloud is redeployed.
+_endpoint_cache = TTLCache(ttl=getattr(config, 'SWIFT_ENDPOINT_TTL', 86400))
+
+# Longer-lived copy of the quota, used by the overview of all the
+# projects.
+_overview_cache = TTLCache(ttl=getattr(config, 'QUOTA_OVERVIEW_CACHE_TTL', 600))
+
+# Process-wide limits on the number of quota reads per second sent to
+# each service by `Quota.overview`.
+_rate_limiters = {service: RateLimiter(rate)
+                  for service, rate in getattr(config, 'QUOTA_RATE_LIMITS', {}).items()}
+
+def _shared_cache():
+    """True if the current user may use the process-wide quota caches"""
+    if not has_request_context():
+        return False
+    roles = session.get('auth', {}).get('roles', [])
+    return bool(set(roles).intersection(['admin', 'usermanager']))
+
+def _rate_limited(service, func):
+    limiter = _rate_limiters.get(service)
+    return limiter.wrap(func) if limiter else func
 
+class Clients(object):
+    """OpenStack clients used by `Quota`, shared by all the projects
+    of `Quota.overview`"""
+    def __init__(self, sess=None):
+        self.session = sess or get_session()
         self.keystone = keystone_client.Client(session=self.session)
         self.nova = nova_client('2', session=self.session)
         self.neutron = neutron_client.Client(session=self.session)
         self.cinder = cinder_client.Client('2', session=self.session)
+
+class QuotaUpdate(dict):
+    """Result of `Quota.set`.
+
+    Maps each service that was updated to a dictionary {key: (old,
+    new)}. Services whose update failed are in `errors`, mapped to the
+    exception raised.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.errors = {}
+
+class Quota:
+    def __init__(self, project_id, refresh=False, clients=None):
+        self._setup(project_id, clients or Clients())
+        cached = None if refresh or not _shared_cache() else _quota_cache.get(project_id)
+        if cached:
+            self._restore(cached)
+        else:
+            self.update_quota()
+
+    def _setup(self, project_id, clients):
+        self.project_id = project_id
+        self.session = clients.session
+        self.keystone = clients.keystone
+        self.nova = clients.nova
+        self.neutron = clients.neutron
+        self.cinder = clients.cinder
         self.storage_url = None
-        self.update_quota()
+        self.errors = {}
+        self.usage = {}
+
+    def _restore(self, cached):
+        quota, usage, self.storage_url = cached
+        self.quota = {service: dict(values) for service, values in quota.items()}
+        self.usage = {service: dict(values) for service, values in usage.items()}
+
+    def _cache(self):
+        if not _shared_cache():
+            return
+        quota = {service: dict(values) for service, values in self.quota.items()}
+        usage = {service: dict(values) for service, values in self.usage.items()}
+        _quota_cache.set(self.project_id, (quota, usage, self.storage_url))
+        _overview_cache.set(self.project_id, (quota, usage, self.storage_url))
+
+    def _uncache(self):
+        _quota_cache.pop(self.project_id)
+        _overview_cache.pop(self.project_id)
+
+    @staticmethod
+    def _empty():
+        return {
+            'nova': { },
+            'neutron': {},
+            'cinder': {},
+            'swift': {'bytes': -1},
+        }
+
+    @classmethod
+    def overview(cls, project_ids, refresh=False):
+        """Return a dictionary {project_id: Quota} for all `project_ids`.
+
+        Quota read in the last `config.QUOTA_OVERVIEW_CACHE_TTL` seconds
+        is not read again, unless `refresh` is true. The other reads are
+        run by at most `config.QUOTA_OVERVIEW_CONCURRENCY` threads,
+        sharing the same clients and limited by
+        `config.QUOTA_RATE_LIMITS`.
+        """
+        clients = Clients()
+        refresh = refresh or not _shared_cache()
+        quotas = {}
+        calls = {}
+        fetched = []
+        for project_id in project_ids:
+            quota = quotas[project_id] = cls.__new__(cls)
+            quota._setup(project_id, clients)
+            cached = None if refresh else (
+                _quota_cache.get(project_id) or _overview_cache.get(project_id))
+            if cached:
+                quota._restore(cached)
+                continue
+            quota.quota = cls._empty()
+            # Neutron quota is read per project too, as its bulk listing
+            # (`list_quotas`) has no usage
+            for service, reader in quota._readers().items():
+                calls[project_id, service] = _rate_limited(service, reader)
+            fetched.append(project_id)
+        if fetched:
+            # Look up the object-store endpoint once, before the threads
+            # do. If that fails, swift is unavailable for all of them,
+            # as in `_get_swift_quota`.
+            try:
+                quotas[fetched[0]]._swift_endpoint()
+            except Exception as ex:
+                app.logger.warning("No swift endpoint found. (exception was: %s", ex)
+                for project_id in fetched:
+                    del calls[project_id, 'swift']
+                    quotas[project_id].usage['swift'] = {}
+
+        results, errors = fan_out(
+            calls,
+            max_workers=getattr(config, 'QUOTA_OVERVIEW_CONCURRENCY', 20),
+            timeout=getattr(config, 'QUOTA_OVERVIEW_TIMEOUT', 120))
+        for (project_id, service), (limits, usage) in results.items():
+            quotas[project_id].quota[service] = limits
+            quotas[project_id].usage[service] = usage
+        for (project_id, service), ex in errors.items():
+            app.logger.error("Unable to get %s quota for project %s: %s",
+                             service, project_id, ex)
+            quotas[project_id].errors[service] = ex
+
+        for project_id in fetched:
+            if not quotas[project_id].errors:
+                quotas[project_id]._cache()
+        return quotas
+
+    def _readers(self):
+        return {
+            'swift': self._get_swift_quota,
+            'nova': self._get_nova_quota,
+            'cinder': self._get_cinder_quota,
+            'neutron': self._get_neutron_quota,
+        }
 
     def update_quota(self):
+        """Read the quota and the usage of all services concurrently.
+
+        Services that fail or do not answer within
+        `config.QUOTA_TIMEOUT` seconds are left empty in `self.quota`
+        and `self.usage`, and the corresponding exception is stored in
+        `self.errors`.
+        """
+        self.quota = self._empty()
+        self.usage = {}
+        results, self.errors = fan_out(
+            self._readers(), timeout=getattr(config, 'QUOTA_TIMEOUT', 10))
+        for service, (limits, usage) in results.items():
+            self.quota[service] = limits
+            self.usage[service] = usage
+        for service, ex in self.errors.items():
+            app.logger.error("Unable to get %s quota for project %s: %s",
+                             service, self.project_id, ex)
+        if self.errors:
+            self._uncache()
+        else:
+            self._cache()
+
+    def _get_swift_quota(self):
         # Create swift client
         try:
-            swift_service = self.keystone.services.find(type='object-store')
-            swift_endpoint = self.keystone.endpoints.find(service_id=swift_service.id, interface='public')
-            self.storage_url = swift_endpoint.url % dict(tenant_id=self.project_id)
+            swift_endpoint = self._swift_endpoint()
+            if swift_endpoint is None:
+                raise NotFound("No object-store service")
+            self.storage_url = swift_endpoint % dict(tenant_id=self.project_id)
             app.logger.info("Using swift storage_url %s", self.storage_url)
             account = swiftclient.head_account(self.storage_url, self.session.get_token())
             swift_curquota = account.get('x-account-meta-quota-bytes', 0)
+            usage = {'bytes': int(account.get('x-account-bytes-used', 0))}
         except Exception as ex:
             app.logger.warning("No swift endpoint found. (exception was: %s", ex)
             swift_curquota = -1
+            usage = {}
+        return {'bytes': swift_curquota}, usage
 
+    def _swift_endpoint(self):
+        endpoint = _endpoint_cache.get('object-store', False)
+        if endpoint is False:
+            try:
+                swift_service = self.keystone.services.find(type='object-store')
+                endpoint = self.keystone.endpoints.find(service_id=swift_service.id, interface='public').url
+            except NotFound:
+                endpoint = None
+            _endpoint_cache.set('object-store', endpoint)
+        return endpoint
 
-        self.quota = {
-            'nova': { },
-            'neutron': {},
-            'cinder': {},
-            'swift': {'bytes': swift_curquota},
-        }
+    # The readers below return two dictionaries, the limits and the
+    # resources in use, read with a single request to each service.
 
-        # Get nova quota
-        quota = self.nova.quotas.get(self.project_id)
-        self.quota['nova'] = {
-            'cores': quota.cores,
-            'instances': quota.instances,
-            'ram': quota.ram * 2**20,
-        }
+    def _get_nova_quota(self):
+        quota = self.nova.quotas.get(self.project_id, detail=True)
+        return self._nova_quota(quota, 'limit'), self._nova_quota(quota, 'in_use')
 
-        quota = self.cinder.quotas.get(self.project_id)
-        self.quota['cinder'] = {
-            'volumes': quota.volumes,
-            'gigabytes': quota.gigabytes * 2**30,
-        }
+    @staticmethod
+    def _nova_quota(quota, field=None):
+        """Convert nova quota to bytes. If `field` is given, `quota` is
+        a detailed quota and only that field of each value is used"""
+        values = {key: getattr(quota, key) for key in ('cores', 'instances', 'ram')}
+        if field:
+            values = {key: value[field] for key, value in values.items()}
+        values['ram'] *= 2**20
+        return values
+
+    def _get_cinder_quota(self):
+        quota = self.cinder.quotas.get(self.project_id, usage=True)
+        return self._cinder_quota(quota, 'limit'), self._cinder_quota(quota, 'in_use')
+
+    @staticmethod
+    def _cinder_quota(quota, field=None):
+        """Convert cinder quota to bytes, see `_nova_quota`"""
+        values = {key: getattr(quota, key) for key in ('volumes', 'gigabytes')}
+        if field:
+            values = {key: value[field] for key, value in values.items()}
+        values['gigabytes'] *= 2**30
+        return values
 
-        # Get neutron quota
-        quota = self.neutron.show_quota(self.project_id)['quota']
-        self.quota['neutron'].update(quota)
+    def _get_neutron_quota(self):
+        # The usage needs the `quota_details` extension: without it
+        # only the limits are read, and the usage is unknown.
+        if _endpoint_cache.get('neutron-quota-details', True):
+            try:
+                quota = self.neutron.show_quota_details(self.project_id)['quota']
+                return ({key: value['limit'] for key, value in quota.items()},
+                        {key: value['used'] for key, value in quota.items()})
+            except (neutron_exceptions.NotFound, neutron_exceptions.BadRequest) as ex:
+                app.logger.warning("Unable to read neutron quota details, reading"
+                                   " the limits only: %s", ex)
+                _endpoint_cache.set('neutron-quota-details', False)
+        return self.neutron.show_quota(self.project_id)['quota'], {}
+
+    def utilisation(self):
+        """Return a list of (service, key, in use, limit, percentage).
+
+        The percentage is None for unlimited resources.
+        """
+        toret = []
+        for service in ('nova', 'cinder', 'neutron', 'swift'):
+            for key, used in sorted(self.usage.get(service, {}).items()):
+                limit = int(self.quota[service].get(key, -1))
+                percent = 100.0 * used / limit if limit > 0 else None
+                toret.append((service, key, used, limit, percent))
+        return toret
+
+    def max_utilisation(self):
+        """Highest usage percentage of any limited resource, or None"""
+        percents = [u[4] for u in self.utilisation() if u[4] is not None]
+        return max(percents) if percents else None
 
     def has_swift(self):
         return self.storage_url is not None
@@ -125,64 +358,86 @@ class Quota:
         return toret
 
     def set(self, quota):
-        """Update quota for project"""
+        """Update quota for project.
+
+        The changes for all the services are computed first, then only
+        the services with actual changes are updated, concurrently.
+
+        Returns a `QuotaUpdate` with the changes applied to each
+        service, and the errors of the services that failed. The quota
+        acknowledged by the services replaces `self.quota` and the
+        cached copy; if any update failed the cached copy is dropped.
+        """
+        if self.errors:
+            raise Exception("Unable to read current quota of %s" % str.join(', ', sorted(self.errors)))
         toupdate = self.from_dict(quota)
-        updated = defaultdict(dict)
-        # Check if we need to update nova quota
-        for key, value in list(toupdate['nova'].items()):
-            if value == self.quota['nova'][key]:
-                del toupdate['nova'][key]
-            else:
-                updated['nova'][key] = (self.quota['nova'][key], toupdate['nova'][key])
-
-        if toupdate['nova']:
-            # All quota is stored in bytes, but nova wants ram quota in megabytes
-            if 'ram' in toupdate['nova']:
-                toupdate['nova']['ram'] = int(toupdate['nova']['ram']/2**20)
-                updated['nova']['ram'] = (
-                    int(self.quota['nova']['ram']/2**20),
-                    toupdate['nova']['ram'])
-        self.nova.quotas.update(self.project_id, **toupdate['nova'])
-
-        for key, value in list(toupdate['cinder'].items()):
-            if value == self.quota['cinder'][key]:
-                del toupdate['cinder'][key]
-            else:
-                updated['cinder'][key] = (self.quota['cinder'][key], toupdate['cinder'][key])
-        if toupdate['cinder']:
-            # All quota is stored in bytes, but cinder wants quota in gigabytes
-            if 'gigabytes' in toupdate['cinder']:
-                toupdate['cinder']['gigabytes'] = int(toupdate['cinder']['gigabytes']/2**30)
-                updated['cinder']['gigabytes'] = (
-                    self.quota['cinder']['gigabytes']/2**30,
-                    toupdate['cinder']['gigabytes'])
-            self.cinder.quotas.update(self.project_id, **toupdate['cinder'])
-
-        for key, value in list(toupdate['neutron'].items()):
-            if value == self.quota['neutron'][key]:
-                del toupdate['neutron'][key]
-            else:
-                updated['neutron'][key] = (self.quota['neutron'][key], toupdate['neutron'][key])
-        self.neutron.update_quota(self.project_id, {'quota': toupdate['neutron']})
-
-        for key, value in list(toupdate['swift'].items()):
-            if value is None or value == int(self.quota['swift'][key]):
-                del toupdate['swift'][key]
-            else:
-                updated['swift'][key] = (self.quota['swift'][key], toupdate['swift'][key])
-                self._update_swift_quota(toupdate['swift'])
-
-        # Re-read from API
-        self.update_quota()
+        changes = {}
+        for service, values in toupdate.items():
+            diff = OrderedDict()
+            for key, value in values.items():
+                current = self.quota[service][key]
+                if service == 'swift':
+                    current = int(current)
+                if value is not None and value != current:
+                    diff[key] = (current, value)
+            if diff:
+                changes[service] = diff
+
+        # All quota is stored in bytes, but nova wants ram quota in
+        # megabytes and cinder wants quota in gigabytes
+        if 'ram' in changes.get('nova', {}):
+            old, new = changes['nova']['ram']
+            changes['nova']['ram'] = (int(old/2**20), int(new/2**20))
+        if 'gigabytes' in changes.get('cinder', {}):
+            old, new = changes['cinder']['gigabytes']
+            changes['cinder']['gigabytes'] = (old/2**30, int(new/2**30))
+
+        writers = {
+            'nova': self._set_nova_quota,
+            'cinder': self._set_cinder_quota,
+            'neutron': self._set_neutron_quota,
+            'swift': self._set_swift_quota,
+        }
+        results, errors = fan_out(
+            {service: partial(writers[service], {k: v[1] for k, v in diff.items()})
+             for service, diff in changes.items()},
+            timeout=getattr(config, 'QUOTA_TIMEOUT', 10))
+
+        updated = QuotaUpdate()
+        for service, values in results.items():
+            self.quota[service] = values
+            updated[service] = changes[service]
+        for service, ex in errors.items():
+            app.logger.error("Unable to update %s quota for project %s: %s",
+                             service, self.project_id, ex)
+            updated.errors[service] = ex
+
+        if errors:
+            self._uncache()
+        else:
+            self._cache()
         return updated
 
+    def _set_nova_quota(self, values):
+        return self._nova_quota(self.nova.quotas.update(self.project_id, **values))
+
+    def _set_cinder_quota(self, values):
+        return self._cinder_quota(self.cinder.quotas.update(self.project_id, **values))
+
+    def _set_neutron_quota(self, values):
+        return self.neutron.update_quota(self.project_id, {'quota': values})['quota']
+
+    def _set_swift_quota(self, values):
+        if not self._update_swift_quota(values):
+            raise Exception("No swift endpoint for project %s" % self.project_id)
+        return dict(self.quota['swift'], **values)
+
     def _update_swift_quota(self, quota):
         if not self.storage_url:
             app.logger.warning("Not updating swift quota as storage_url is empty")
-            return
-        token = self.session.get_token()
-        account = swiftclient.head_account(self.storage_url, token)
+            return False
         swiftclient.post_account(url=self.storage_url,
-                                 token=token,
+                                 token=self.session.get_token(),
                                  headers={'x-account-meta-quota-bytes': str(quota['bytes'])})
+        return True
 
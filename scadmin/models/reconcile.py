@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import json
+import os
+import tempfile
+import time
+
+from flask import current_app as app
+
+from scadmin.background import BackgroundValue
+from scadmin.models.inventory import inventory
+from scadmin.models.sympa import ML
+from scadmin import config
+
+
+class Reconciliation(object):
+    """Difference between the keystone users and the mailing list
+    subscribers, as computed at `timestamp`.
+
+    * `missing`: sorted list of addresses to subscribe
+    * `exceeding`: sorted list of subscribers that are not users
+    * `applied`: messages of the last automatic additions
+    * `error`: message of the last failed computation, if it failed
+      after this one
+    """
+
+    def __init__(self, missing, exceeding, timestamp=None, applied=None, error=None):
+        self.missing = sorted(missing)
+        self.exceeding = sorted(exceeding)
+        self.timestamp = timestamp or time.time()
+        self.applied = applied or []
+        self.error = error
+
+    def age(self):
+        return time.time() - self.timestamp
+
+    def updated(self, added=(), removed=()):
+        """Return a copy without the addresses `added` to or `removed`
+        from the mailing list"""
+        return Reconciliation(set(self.missing).difference(added),
+                              set(self.exceeding).difference(removed),
+                              self.timestamp, self.applied, self.error)
+
+    def to_dict(self):
+        return {'missing': self.missing,
+                'exceeding': self.exceeding,
+                'timestamp': self.timestamp,
+                'applied': self.applied,
+                'error': self.error}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['missing'], data['exceeding'], data['timestamp'],
+                   data.get('applied'), data.get('error'))
+
+
+def user_emails(snapshot):
+    """Addresses that should be subscribed to the mailing list: those of
+    the users with a role on some project, plus the alternate addresses
+    of `config.SYMPA_EMAIL_MAPPINGS`"""
+    emails = [getattr(user, 'email', None) for user in snapshot.users.values()]
+    return emails + [i[1] for i in config.SYMPA_EMAIL_MAPPINGS if i[1]]
+
+
+class Reconciler(BackgroundValue):
+    """Process-wide, periodically computed `Reconciliation`.
+
+    The first call to `get` computes the result, which is then computed
+    again every `config.SYMPA_RECONCILE_INTERVAL` seconds as described
+    in `BackgroundValue`. If `config.SYMPA_AUTO_APPLY` is true, the
+    missing addresses are then subscribed,
+    `config.SYMPA_AUTO_APPLY_BATCH` at a time.
+
+    The result is computed without holding the lock protecting it, so
+    `update` never waits for Sympa; changes recorded by `update` while
+    a computation runs are applied to its result.
+
+    If `config.SYMPA_RECONCILE_PATH` is set, the result is saved there
+    as JSON and shared by all the worker processes, and lock files next
+    to it let only one worker at a time compute it.
+    """
+
+    name = 'Mailing list reconciliation'
+    path_setting = 'SYMPA_RECONCILE_PATH'
+    interval_setting = ('SYMPA_RECONCILE_INTERVAL', 900)
+
+    def __init__(self):
+        BackgroundValue.__init__(self)
+        # (time, added, removed) of the calls to `update`
+        self._changes = []
+
+    @property
+    def result(self):
+        return self.value
+
+    @staticmethod
+    def _read(path):
+        with open(path) as fd:
+            return Reconciliation.from_dict(json.load(fd))
+
+    @staticmethod
+    def _write(path, result):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'w') as out:
+            json.dump(result.to_dict(), out)
+        os.rename(tmp, path)
+
+    def get(self, keystone):
+        """Return the latest result, computing it if there is none yet"""
+        if self.result is None:
+            self.run(keystone, max_age=self.interval)
+        self._schedule(keystone)
+        return self.result
+
+    def _refresh(self, keystone, max_age):
+        return self.run(keystone, max_age=max_age, blocking=False)
+
+    def run(self, keystone, max_age=None, refresh=False, blocking=True):
+        """Compare users and subscribers again, and subscribe the missing
+        addresses if `config.SYMPA_AUTO_APPLY` is true.
+
+        Nothing is done if the current result is younger than `max_age`
+        seconds, or if `blocking` is false and another thread or process
+        is already computing it. If `refresh` is true, the subscribers
+        are read again from Sympa. Returns True if a new result was
+        computed.
+        """
+        with self._refreshing(blocking) as acquired:
+            if not acquired:
+                return False
+            if max_age is not None and self.result is not None \
+               and self.result.age() < max_age:
+                return False
+            start = time.time()
+            try:
+                ml = ML()
+                ml.login()
+                if refresh:
+                    ml.refresh()
+                missing, exceeding = ml.missing_and_exceeding(
+                    user_emails(inventory.get(keystone)))
+                result = Reconciliation(missing, exceeding, start)
+                if getattr(config, 'SYMPA_AUTO_APPLY', False):
+                    result = self._apply(ml, result)
+            except Exception as ex:
+                self._failed(ex)
+                raise
+
+            with self._publishing():
+                for when, added, removed in self._changes:
+                    if when >= start:
+                        result = result.updated(added, removed)
+                self._changes = [c for c in self._changes if c[0] >= start]
+                self._publish(result)
+            return True
+
+    def _failed(self, ex):
+        """Record on the current result that computing a new one failed"""
+        with self._publishing():
+            if self.result is not None:
+                result = self.result.updated()
+                result.error = "%s: %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), ex)
+                self._publish(result)
+
+    def _apply(self, ml, result):
+        size = getattr(config, 'SYMPA_AUTO_APPLY_BATCH', 50)
+        added, applied = set(), []
+        for i in range(0, len(result.missing), size):
+            batch = result.missing[i:i+size]
+            info, err = ml.add(batch)
+            applied.extend(info + err)
+            if err:
+                app.logger.error("Errors while subscribing %d addresses to the mailing list,"
+                                 " the others will be retried later: %s", len(batch), err)
+                break
+            app.logger.info("Subscribed %d addresses to the mailing list", len(batch))
+            added.update(batch)
+        result = result.updated(added=added)
+        result.applied = applied
+        return result
+
+    def update(self, added=(), removed=()):
+        """Record the changes made to the mailing list from the dashboard"""
+        with self._publishing():
+            self._changes.append((time.time(), list(added), list(removed)))
+            if self.result is not None:
+                self._publish(self.result.updated(added, removed))
+
+
+reconciler = Reconciler()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from scadmin.cache import TTLCache
+from scadmin.exceptions import NotFound
+from scadmin import config
+
+
+class RoleCache(object):
+    """Process-wide cache of the keystone role catalogue.
+
+    The catalogue is fetched with whatever keystone client is passed
+    to the lookup methods, and kept for `config.ROLE_CACHE_TTL`
+    seconds. Lookups of unknown roles refresh the catalogue once
+    before giving up.
+    """
+
+    def __init__(self):
+        self._cache = TTLCache()
+
+    def _load(self, keystone, refresh=False):
+        catalogue = None if refresh else self._cache.get('roles')
+        if catalogue is None:
+            byid = {r.id: r.name for r in keystone.roles.list()}
+            byname = {name: rid for rid, name in byid.items()}
+            catalogue = (byid, byname)
+            self._cache.set('roles', catalogue,
+                            ttl=getattr(config, 'ROLE_CACHE_TTL', 3600))
+        return catalogue
+
+    def names(self, keystone, role_ids=()):
+        """Return a dictionary {role_id: role_name}.
+
+        Like `name`, the catalogue is refreshed once if any of
+        `role_ids` is unknown.
+        """
+        names = self._load(keystone)[0]
+        if any(rid not in names for rid in role_ids):
+            names = self._load(keystone, refresh=True)[0]
+        return names
+
+    def ids(self, keystone):
+        """Return a dictionary {role_name: role_id}"""
+        return self._load(keystone)[1]
+
+    def name(self, keystone, role_id):
+        try:
+            return self.names(keystone)[role_id]
+        except KeyError:
+            try:
+                return self._load(keystone, refresh=True)[0][role_id]
+            except KeyError:
+                raise NotFound('Role %s not found' % role_id)
+
+    def id(self, keystone, role_name):
+        try:
+            return self.ids(keystone)[role_name]
+        except KeyError:
+            try:
+                return self._load(keystone, refresh=True)[1][role_name]
+            except KeyError:
+                raise NotFound('Role %s not found' % role_name)
+
+    def invalidate(self):
+        self._cache.invalidate()
+
+
+role_cache = RoleCache()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""Inventory snapshots stored in a memory-mapped file.
+
+One process writes the file with `write`, every worker maps it with
+`MappedSnapshot` and reads records straight from the mapped pages.
+The file contains:
+
+* a header with the timestamp and the size of each section
+* the string table: offsets followed by the UTF-8 encoded strings.
+  Every string (ids, names, emails...) is stored only once, all the
+  other sections refer to strings by their index in this table
+* the projects table: one row of string indices per project, sorted
+  by project id
+* the users table: one row per user, sorted by user id
+* the arrays of an `AssignmentStore`: the string indices of the
+  interned user, project and role ids, followed by its columns,
+  offsets and permutations
+
+Tables are arrays of native unsigned 32-bit integers, so the file is
+only meant to be shared by processes on the same host.
+"""
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from array import array
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+import mmap
+import os
+import struct
+import time
+
+from scadmin.models.assignments import AssignmentStore
+
+
+MAGIC = b'SCINV002'
+HEADER = struct.Struct('=8sdIIIIIIII')
+# Index of a missing value
+NONE = 0xffffffff
+
+PROJECT_FIELDS = ('id', 'name', 'domain_id', 'enabled', 'description',
+                  'faculty', 'institute',
+                  'owner', 'owner_email',
+                  'contact', 'contact_email',
+                  's3it_owner', 's3it_owner_email')
+USER_FIELDS = ('id', 'name', 'email', 'domain_id', 'enabled')
+
+
+def _to_dict(obj):
+    to_dict = getattr(obj, 'to_dict', None)
+    if to_dict:
+        return to_dict()
+    return vars(obj)
+
+def _padded(size):
+    return (size + 3) & ~3
+
+
+class _Writer(object):
+    def __init__(self):
+        self.index = {}
+        self.offsets = array('I', [0])
+        self.blob = bytearray()
+
+    def intern(self, value):
+        if value is None:
+            return NONE
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        value = str(value)
+        try:
+            return self.index[value]
+        except KeyError:
+            self.blob += value.encode('utf-8')
+            self.offsets.append(len(self.blob))
+            idx = self.index[value] = len(self.offsets) - 2
+            return idx
+
+    def table(self, records, fields):
+        rows = array('I')
+        for record in sorted(records, key=lambda r: r['id']):
+            rows.extend(self.intern(record.get(field)) for field in fields)
+        return rows
+
+
+def write(path, snapshot):
+    """Atomically replace `path` with the content of `snapshot`.
+
+    >>> import shutil, tempfile
+    >>> from types import SimpleNamespace
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> path = os.path.join(tmpdir, 'snapshot')
+    >>> write(path, SimpleNamespace(
+    ...     timestamp=0.0,
+    ...     projects={'p1': SimpleNamespace(id='p1', name='Zürich', enabled=True)},
+    ...     users={'u1': SimpleNamespace(id='u1', email='jörg@example.org')},
+    ...     assignments=[('u1', 'p1', 'member')]))
+    >>> snapshot = MappedSnapshot(path)
+    >>> snapshot.projects['p1'].name, snapshot.projects['p1'].enabled
+    ('Zürich', True)
+    >>> snapshot.users['u1'].to_dict()
+    {'id': 'u1', 'email': 'jörg@example.org'}
+    >>> list(snapshot.assignments)
+    [('u1', 'p1', 'member')]
+
+    Empty tables are written and read back too:
+
+    >>> write(path, SimpleNamespace(timestamp=0.0, projects={}, users={},
+    ...                             assignments=[]))
+    >>> snapshot = MappedSnapshot(path)
+    >>> len(snapshot.projects), len(snapshot.users), len(snapshot.assignments)
+    (0, 0, 0)
+    >>> 'p1' in snapshot.projects, snapshot.assignments.members('p1')
+    (False, defaultdict(<class 'list'>, {}))
+    >>> shutil.rmtree(tmpdir)
+    """
+    w = _Writer()
+    projects = w.table([_to_dict(p) for p in snapshot.projects.values()], PROJECT_FIELDS)
+    users = w.table([_to_dict(u) for u in snapshot.users.values()], USER_FIELDS)
+    store = snapshot.assignments
+    if not isinstance(store, AssignmentStore):
+        store = AssignmentStore.build(store)
+    ids = [array('I', (w.intern(i) for i in names))
+           for names in (store.users, store.projects, store.roles)]
+    arrays = ids + [array('I', column) for column in (
+        store.user_col, store.project_col, store.role_col,
+        store.project_offsets,
+        store.user_perm, store.user_offsets,
+        store.role_perm, store.role_offsets)]
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, snapshot.timestamp,
+                            len(w.offsets) - 1, len(w.blob),
+                            len(projects) // len(PROJECT_FIELDS),
+                            len(users) // len(USER_FIELDS),
+                            len(store),
+                            len(store.users), len(store.projects), len(store.roles)))
+        f.write(w.offsets.tobytes())
+        f.write(bytes(w.blob) + b'\0' * (_padded(len(w.blob)) - len(w.blob)))
+        f.write(projects.tobytes())
+        f.write(users.tobytes())
+        for a in arrays:
+            f.write(a.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Record(object):
+    """Read-only view of a row of the projects or users table.
+
+    Like keystone resources, missing fields raise `AttributeError`.
+    """
+    __slots__ = ('_snapshot', '_row', '_fields')
+
+    def __init__(self, snapshot, row, fields):
+        self._snapshot = snapshot
+        self._row = row
+        self._fields = fields
+
+    def __getattr__(self, attr):
+        try:
+            idx = self._row[self._fields.index(attr)]
+        except ValueError:
+            raise AttributeError(attr)
+        if idx == NONE:
+            raise AttributeError(attr)
+        value = self._snapshot.string(idx)
+        if attr == 'enabled':
+            return value == 'true'
+        return value
+
+    def to_dict(self):
+        toret = {}
+        for attr in self._fields:
+            try:
+                toret[attr] = getattr(self, attr)
+            except AttributeError:
+                pass
+        return toret
+
+
+class _Table(Mapping):
+    """Mapping {id: Record} over a table sorted by id"""
+
+    def __init__(self, snapshot, rows, fields):
+        self._snapshot = snapshot
+        self._rows = rows
+        self._fields = fields
+        self._width = len(fields)
+
+    def _row(self, i):
+        return self._rows[i*self._width:(i+1)*self._width]
+
+    def _id(self, i):
+        return self._snapshot.string(self._rows[i*self._width])
+
+    def __len__(self):
+        return len(self._rows) // self._width
+
+    def __iter__(self):
+        return (self._id(i) for i in range(len(self)))
+
+    def __getitem__(self, key):
+        # binary search on the sorted ids
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._id(lo) == key:
+            return Record(self._snapshot, self._row(lo), self._fields)
+        raise KeyError(key)
+
+    def values(self):
+        return [Record(self._snapshot, self._row(i), self._fields) for i in range(len(self))]
+
+    def items(self):
+        return [(r.id, r) for r in self.values()]
+
+
+class _Strings(Sequence):
+    """Sequence of the strings referenced by an array of string indices"""
+
+    def __init__(self, snapshot, indices):
+        self._snapshot = snapshot
+        self._indices = indices
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, i):
+        return self._snapshot.string(self._indices[i])
+
+
+class MappedSnapshot(object):
+    """Same interface as `inventory.Snapshot`, backed by a file
+    written with `write`"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        (magic, self.timestamp, nstrings, bloblen, nprojects, nusers,
+         nassignments, nauser, naproject, narole) = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError("%s is not an inventory snapshot" % path)
+
+        def section(start, size):
+            return buf[start:start+size], start+size
+
+        def ints(start, count):
+            return buf[start:start+4*count].cast('I'), start+4*count
+
+        offsets, pos = section(HEADER.size, 4*(nstrings+1))
+        self._offsets = offsets.cast('I')
+        self._blob, pos = section(pos, bloblen)
+        pos = _padded(pos)
+        projects, pos = section(pos, 4*nprojects*len(PROJECT_FIELDS))
+        users, pos = section(pos, 4*nusers*len(USER_FIELDS))
+        arrays = []
+        for count in (nauser, naproject, narole,
+                      nassignments, nassignments, nassignments,
+                      naproject+1,
+                      nassignments, nauser+1,
+                      nassignments, narole+1):
+            a, pos = ints(pos, count)
+            arrays.append(a)
+
+        self.string = lru_cache(maxsize=65536)(self._string)
+        self.projects = _Table(self, projects.cast('I'), PROJECT_FIELDS)
+        self.users = _Table(self, users.cast('I'), USER_FIELDS)
+        self.assignments = AssignmentStore(
+            *([_Strings(self, ids) for ids in arrays[:3]] + arrays[3:]))
+
+    def _string(self, idx):
+        return str(self._blob[self._offsets[idx]:self._offsets[idx+1]], 'utf-8')
+
+    def age(self):
+        return time.time() - self.timestamp
@@ -23,10 +23,66 @@ __docformat__ = 'reStructuredText'
 __author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
 __author__ = 'Mattia Belluco <mattia.belluco@uzh.ch>'
 
+from contextlib import contextmanager
+from functools import partial
+import threading
+import time
+
+import requests
 import robobrowser
 from flask import session, current_app as app
 
+from scadmin.cache import TTLCache
 from scadmin import config
+from scadmin.models.sympasoap import SympaFault, soap_client
+from scadmin.utils import fan_out
+
+
+class BrowserPool(object):
+    """Process-wide, thread-safe pool of browsers logged in to Sympa.
+
+    A browser is used by one thread at a time: `acquire` returns an
+    idle browser (or a new one, not logged in yet) and `release` gives
+    it back. Browsers idle for more than `idle` seconds are dropped, and
+    at most `size` idle browsers are kept.
+    """
+
+    def __init__(self, size=None, idle=None):
+        self.size = size
+        self.idle = idle
+        self._browsers = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._browsers:
+                br, last_used = self._browsers.pop()
+                if self.idle is None or now - last_used < self.idle:
+                    return br
+        br = robobrowser.RoboBrowser(user_agent='Chrome', parser='html.parser')
+        br.session.verify = False
+        app.logger.warning("Disabling SSL verification to access %s", config.SYMPA_URL)
+        br.logged_in = False
+        return br
+
+    def release(self, br):
+        with self._lock:
+            if self.size is None or len(self._browsers) < self.size:
+                self._browsers.append((br, time.monotonic()))
+
+    def clear(self):
+        with self._lock:
+            del self._browsers[:]
+
+
+# list name -> set of subscribed email addresses. Updated locally by
+# `ML.add` and `ML.remove`, and read again from Sympa when it expires
+# or on request.
+_subscribers = TTLCache(ttl=getattr(config, 'SYMPA_CACHE_TTL', 3600))
+
+_browsers = BrowserPool(size=getattr(config, 'SYMPA_POOL_SIZE', 4),
+                        idle=getattr(config, 'SYMPA_SESSION_IDLE', 600))
 
 
 class ML:
@@ -39,18 +95,64 @@ class ML:
             self.lists.extend(config.SYMPA_LISTS)
         else:
             app.logger.error("Error in parsing config.SYMPA_LISTS")
-        self.url_review = '{}?sortby=email&action=review&list={}&size={}'.format(
-            self.url_base, self.lists[0], config.SYMPA_SIZE)
+        self.url_review = self._url_review(self.lists[0])
         self.url_remove = self.url_review
         self.url_login = '%s/login' % (self.url_base)
         # SYMPA(6.2.32): changed url from 'add_request' to 'import'
-        self.br = robobrowser.RoboBrowser(user_agent='Chrome', parser='html.parser')
-        self.br.session.verify = False
-        app.logger.warning("Disabling SSL verification to access %s", self.url_base)
-        self.logged_in = False
+        self._local = threading.local()
+        # 'soap' uses the SOAP interface of Sympa, 'html' the web
+        # interface. The web interface is also used for a while after
+        # the SOAP server fails.
+        self.backend = getattr(config, 'SYMPA_BACKEND', 'html')
+        self.soap = None
+        if self.backend == 'soap':
+            client = soap_client()
+            if client.available():
+                self.soap = client
+
+    def _url_review(self, ml):
+        return '{}?sortby=email&action=review&list={}&size={}'.format(
+            self.url_base, ml, config.SYMPA_SIZE)
+
+    # Every thread using this object gets its own browser
+    @property
+    def br(self):
+        return getattr(self._local, 'br', None)
+
+    @br.setter
+    def br(self, value):
+        self._local.br = value
+
+    @contextmanager
+    def browser(self):
+        """Use a browser from the pool as `self.br`.
+
+        The browser goes back to the pool unless an exception is raised.
+        """
+        if self.br is not None:
+            # nested call
+            yield self.br
+            return
+        self.br = _browsers.acquire()
+        try:
+            yield self.br
+            _browsers.release(self.br)
+        finally:
+            self.br = None
 
     def login(self):
-        """Login to the mailing list"""
+        """Login to the mailing list, unless the pooled session already is"""
+        if self.soap is not None:
+            try:
+                self.soap.login()
+                return
+            except (SympaFault, requests.RequestException) as ex:
+                self._soap_failed(self.soap, ex)
+        with self.browser():
+            if not self.br.logged_in:
+                self._login()
+
+    def _login(self):
         self.br.open(self.url_login)
 
         form = self.br.get_forms()[3]
@@ -59,28 +161,86 @@ class ML:
         form['passwd'] = config.SYMPA_PASSWORD
 
         self.br.submit_form(form)
-        self.logged_in = True
+        self.br.logged_in = True
+
+    def _soap_failed(self, soap, ex):
+        app.logger.warning("Error from Sympa SOAP server %s, using the web interface: %s",
+                           soap.url, ex)
+        soap.failed()
+        self.soap = None
+
+    def _with_backend(self, method, html, *args):
+        """Call `method` of the SOAP client, or `html` if SOAP is not
+        used or fails"""
+        soap = self.soap
+        if soap is not None:
+            try:
+                return getattr(soap, method)(*args)
+            except (SympaFault, requests.RequestException) as ex:
+                self._soap_failed(soap, ex)
+        return html(*args)
+
+    def _on_login_page(self):
+        return self.br.url.startswith(self.url_login) or \
+            self.br.find('input', attrs={'name': 'passwd'}) is not None
 
     def open(self, url):
-        if not self.logged_in:
-            self.login()
+        """Open `url`, logging in again if the session expired"""
+        if not self.br.logged_in:
+            self._login()
         self.br.open(url)
-        
-    def list(self, allusers=False):
-        """Return a list of email addresses subscribed to the mailing list"""
-        subscribers = []
-        self.open(self.url_review)
+        if self._on_login_page():
+            app.logger.info("Sympa session expired, logging in again")
+            self._login()
+            self.br.open(url)
+
+    def refresh(self):
+        """Forget the cached subscribers of all lists"""
+        for ml in self.lists:
+            _subscribers.pop(ml)
+
+    def _update_cache(self, ml, users, subscribed, errors):
+        """Apply the result of an add or remove operation on list `ml` to
+        the cached subscribers, or drop them if Sympa reported errors"""
+        if errors:
+            _subscribers.pop(ml)
+            return
+        users = set(u.lower() for u in users if u and '@' in u)
+        # Chunks of the same list run concurrently
+        _subscribers.update(ml, lambda cached: cached | users if subscribed else cached - users)
 
-        for row in self.br.find_all('tr'):
-            email = row.find('a').text
-            if email and email.strip():
-                subscribers.append(email.lower())
+    def list(self, allusers=False, refresh=False):
+        """Return a list of email addresses subscribed to the mailing list.
+
+        The subscribers are cached for `config.SYMPA_CACHE_TTL` seconds,
+        unless `refresh` is true.
+        """
+        cached = None if refresh else _subscribers.get(self.lists[0])
+        if cached is None:
+            cached = self._review(self.lists[0])
+            _subscribers.set(self.lists[0], cached)
+        subscribers = sorted(cached)
 
         if allusers:
             subscribers.extend([i[0] for i in config.SYMPA_EMAIL_MAPPINGS])
 
         return subscribers
 
+    def _review(self, ml):
+        """Return the set of addresses subscribed to list `ml`"""
+        return self._with_backend('review', self._html_review, ml)
+
+    def _html_review(self, ml):
+        subscribers = set()
+        with self.browser():
+            self.open(self._url_review(ml))
+
+            for row in self.br.find_all('tr'):
+                email = row.find('a').text
+                if email and email.strip():
+                    subscribers.add(email.lower())
+        return subscribers
+
     def missing_and_exceeding(self, users):
         users = [u.lower() for u in users if u and u.strip()]
         subscribers = [s.strip() for s in self.list(allusers=True) if s and s.strip()]
@@ -88,28 +248,73 @@ class ML:
         exceeding = set(subscribers).difference(users)
         return missing, exceeding
 
+    def _run(self, operation, users, quiet):
+        """Run `operation(ml, users, quiet)` on every list, concurrently.
+
+        Big sets of addresses are split in chunks of
+        `config.SYMPA_CHUNK_SIZE`; each chunk of each list is sent by a
+        different thread, with a browser of its own. Returns a dictionary
+        {list: (info, err)}.
+        """
+        users = list(users)
+        size = getattr(config, 'SYMPA_CHUNK_SIZE', 500)
+        chunks = [users[i:i+size] for i in range(0, len(users), size)]
+        calls = {(ml, n): partial(operation, ml, chunk, quiet)
+                 for ml in self.lists for n, chunk in enumerate(chunks)}
+        results, errors = fan_out(calls, max_workers=getattr(config, 'SYMPA_CONCURRENCY', 4))
+
+        bylist = {}
+        failed = {}
+        for key in sorted(calls, key=lambda k: (self.lists.index(k[0]), k[1])):
+            info, err = bylist.setdefault(key[0], ([], []))
+            if key in errors:
+                failed.setdefault(key[0], errors[key])
+            else:
+                info.extend(results[key][0])
+                err.extend(results[key][1])
+        for ml, ex in failed.items():
+            _subscribers.pop(ml)
+            bylist[ml][1].append("Error on list %s: %s" % (ml, ex))
+        return bylist
+
+    @staticmethod
+    def _merge(bylist):
+        info, err = [], []
+        for ml_info, ml_err in bylist.values():
+            info.extend(ml_info)
+            err.extend(ml_err)
+        return info, err
+
     def add(self, users, quiet=True):
-        """Add all email addresses listed in `users to the mailing list.
+        """Add all email addresses listed in `users to all the mailing lists.
 
         Returns two lists `info`, `err` containins info and error messages
         """
+        return self._merge(self._run(self._add, users, quiet))
+
+    def _add(self, ml, users, quiet=True):
+        info, err = self._with_backend('add', self._html_add, ml, users, quiet)
+        self._update_cache(ml, users, True, err)
+        return info, err
+
+    def _html_add(self, ml, users, quiet=True):
         info, err = [], []
-        for ml in self.lists:
+        with self.browser():
             url_add = '%s/import/%s' % (self.url_base, ml)
             self.open(url_add)
-    
+
             form = self.br.get_forms()[1]
             form['dump'] = str.join('\n', [u for u in users if u and  '@' in u])
-    
+
             # SYMPA(6.2.32): changed back quietly to quiet.
             if quiet:
                 form['quiet'].value = ['quiet']
-            
+
             # SYMPA(6.2.32): added mandatory form value.
             form['action_import'].value = ['Add+subscribers']
-    
+
             self.br.submit_form(form)
-    
+
             if self.br.find(id='ephemeralMsg'):
                 info.extend(self.br.find(id='ephemeralMsg').text.strip().splitlines())
             if self.br.find(id='ErrorMsg'):
@@ -139,26 +344,34 @@ class ML:
 
         return info, err
 
-
     def remove(self, users, quiet=True):
-        """Remove all email addresses listed in `users from the mailing list.
+        """Remove all email addresses listed in `users from all the mailing lists.
 
         Returns two lists `info`, `err` containins info and error messages
         """
-        self.open(self.url_remove)
+        return self._merge(self._run(self._remove, users, quiet))
 
-        form = self.br.get_forms()[4]
-        form['email'].value = users
+    def _remove(self, ml, users, quiet=True):
+        info, err = self._with_backend('remove', self._html_remove, ml, users, quiet)
+        self._update_cache(ml, users, False, err)
+        return info, err
 
-        if quiet:
-            form['quiet'].value = ['on']
+    def _html_remove(self, ml, users, quiet=True):
+        info, err = [], []
+        with self.browser():
+            self.open(self._url_review(ml))
 
-        self.br.submit_form(form)
+            form = self.br.get_forms()[4]
+            form['email'].value = users
 
-        info, err = [], []
-        if self.br.find(id='ephemeralMsg'):
-            info.extend(self.br.find(id='ephemeralMsg').text.strip().splitlines())
-        if self.br.find(id='ErrorMsg'):
-            err.extend(self.br.find(id='ErrorMsg').text.strip().splitlines())
+            if quiet:
+                form['quiet'].value = ['on']
+
+            self.br.submit_form(form)
+
+            if self.br.find(id='ephemeralMsg'):
+                info.extend(self.br.find(id='ephemeralMsg').text.strip().splitlines())
+            if self.br.find(id='ErrorMsg'):
+                err.extend(self.br.find(id='ErrorMsg').text.strip().splitlines())
 
         return info, err
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""Client for the SOAP interface of Sympa.
+
+Only the calls needed by `scadmin.models.sympa.ML` are implemented:
+`login`, `review`, `add` and `del`. Requests and responses are built
+and parsed with `xml.etree`; the session cookie set by `login` is kept
+by a `requests.Session` shared by all the threads.
+"""
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import requests
+
+from scadmin import config
+
+
+SOAP_ENV = 'http://schemas.xmlsoap.org/soap/envelope/'
+SYMPA_NS = 'urn:sympasoap'
+
+
+class SympaFault(Exception):
+    """SOAP fault returned by Sympa"""
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def envelope(method, params):
+    """Return the SOAP request calling `method` with the list of
+    (name, value) `params`"""
+    env = ET.Element('{%s}Envelope' % SOAP_ENV)
+    body = ET.SubElement(env, '{%s}Body' % SOAP_ENV)
+    call = ET.SubElement(body, '{%s}%s' % (SYMPA_NS, method))
+    for name, value in params:
+        ET.SubElement(call, name).text = str(value)
+    return ET.tostring(env, encoding='utf-8')
+
+
+def parse(content):
+    """Return the list of values in a SOAP response, or raise
+    `SympaFault`"""
+    try:
+        root = ET.fromstring(content)
+    except ET.ParseError as ex:
+        raise SympaFault('Client', 'Invalid response from Sympa: %s' % ex)
+    fault = root.find('.//{%s}Fault' % SOAP_ENV)
+    if fault is not None:
+        raise SympaFault(fault.findtext('faultcode', ''),
+                         fault.findtext('faultstring', '') or fault.findtext('detail', ''))
+    body = root.find('{%s}Body' % SOAP_ENV)
+    if body is None or not len(body):
+        return []
+    response = body[0]
+    return [el.text for el in response.iter()
+            if el is not response and not len(el) and el.text is not None]
+
+
+class SympaSOAP(object):
+    """Thread-safe client of the Sympa SOAP server at `url`"""
+
+    def __init__(self, url, username, password, verify=True, timeout=60):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._http = requests.Session()
+        self._http.verify = verify
+        self._lock = threading.Lock()
+        self._logged_in = False
+        self._down_until = 0
+
+    def available(self):
+        """False for a while after `failed` was called"""
+        return time.monotonic() >= self._down_until
+
+    def failed(self, retry=None):
+        """Mark the server as unusable for `retry` seconds
+        (`config.SYMPA_SOAP_RETRY` by default)"""
+        if retry is None:
+            retry = getattr(config, 'SYMPA_SOAP_RETRY', 300)
+        with self._lock:
+            self._logged_in = False
+            self._down_until = time.monotonic() + retry
+
+    def _call(self, method, *params):
+        response = self._http.post(
+            self.url, data=envelope(method, params), timeout=self.timeout,
+            headers={'Content-Type': 'text/xml; charset=utf-8',
+                     'SOAPAction': '"%s#%s"' % (SYMPA_NS, method)})
+        if response.status_code >= 400 and not response.content:
+            response.raise_for_status()
+        return parse(response.content)
+
+    def login(self, force=False):
+        with self._lock:
+            if force or not self._logged_in:
+                self._call('login', ('email', self.username), ('password', self.password))
+                self._logged_in = True
+
+    def call(self, method, *params):
+        """Call `method`, logging in first and again if the session expired"""
+        self.login()
+        try:
+            return self._call(method, *params)
+        except SympaFault as ex:
+            if 'authenticat' not in str(ex).lower():
+                raise
+        self.login(force=True)
+        return self._call(method, *params)
+
+    def review(self, ml):
+        """Return the set of addresses subscribed to list `ml`"""
+        return set(email.strip().lower() for email in self.call('review', ('list', ml))
+                   if email and '@' in email)
+
+    def add(self, ml, users, quiet=True):
+        """Subscribe `users` to list `ml`, one at a time.
+
+        Returns two lists `info`, `err` like `ML.add`.
+        """
+        info, err = [], []
+        for email in users:
+            if not email or '@' not in email:
+                continue
+            try:
+                self.call('add', ('list', ml), ('email', email), ('gecos', ''),
+                          ('quiet', int(bool(quiet))))
+                info.append("%s has been subscribed to list %s" % (email, ml))
+            except SympaFault as ex:
+                if 'already' in str(ex).lower():
+                    info.append("%s is already subscriber of list %s" % (email, ml))
+                else:
+                    err.append("Unable to add %s to list %s: %s" % (email, ml, ex))
+        return info, err
+
+    def remove(self, ml, users, quiet=True):
+        """Unsubscribe `users` from list `ml`, one at a time.
+
+        Returns two lists `info`, `err` like `ML.remove`.
+        """
+        info, err = [], []
+        for email in users:
+            if not email or '@' not in email:
+                continue
+            try:
+                self.call('del', ('list', ml), ('email', email), ('quiet', int(bool(quiet))))
+                info.append("%s has been removed from list %s" % (email, ml))
+            except SympaFault as ex:
+                err.append("Unable to remove %s from list %s: %s" % (email, ml, ex))
+        return info, err
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def soap_client():
+    """Return the process-wide `SympaSOAP` client for the configured server"""
+    url = getattr(config, 'SYMPA_SOAP_URL', None) or '%s/sympasoap' % config.SYMPA_URL
+    with _clients_lock:
+        if url not in _clients:
+            # Same as the web interface: SSL certificates are not verified
+            _clients[url] = SympaSOAP(url, config.SYMPA_USERNAME, config.SYMPA_PASSWORD,
+                                      verify=False)
+        return _clients[url]
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2018, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+import time
+
+from flask import current_app as app, copy_current_request_context
+
+from scadmin import config
+
+
+def trigrams(text):
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+class UserIndex(object):
+    """Process-wide in-memory index of user ids and email addresses.
+
+    Answers prefix and substring queries without contacting keystone.
+    The index is built from `Users.list_users()`, plus the users of other
+    domains with role assignments (`Users.list()`), which are only found
+    by id like in the keystone search. Once it is older than
+    `config.USER_INDEX_TTL` seconds it is rebuilt in a background
+    thread, while queries keep being answered from the old copy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._refreshing = False
+        self.updated = None
+        # users: uid -> user dict, as returned by Users.list_users()
+        # keys: sorted list of (lowercase key, uid, is_email)
+        # grams: trigram -> set of positions in `keys`
+        # id_only: uids of `others` in `build`
+        self._data = ({}, [], {}, set())
+
+    def build(self, users, others=()):
+        """Index `users`, and the ids of the users in `others`, which are
+        not returned by email searches"""
+        byid = OrderedDict((u['id'], u) for u in users)
+        id_only = set()
+        for u in others:
+            if u['id'] not in byid:
+                byid[u['id']] = u
+                id_only.add(u['id'])
+        keys = []
+        for u in byid.values():
+            keys.append((u['id'].lower(), u['id'], False))
+            if u.get('email'):
+                keys.append((u['email'].lower(), u['id'], True))
+        keys.sort()
+        grams = {}
+        for pos, (key, uid, is_email) in enumerate(keys):
+            for gram in trigrams(key):
+                grams.setdefault(gram, set()).add(pos)
+        self._data = (byid, keys, grams, id_only)
+        self.updated = time.time()
+
+    def age(self):
+        if self.updated is None:
+            return None
+        return time.time() - self.updated
+
+    def refresh(self, users):
+        """Make sure the index is usable, rebuilding it if it is stale.
+
+        `users` is a `Users` instance used to list the users; the first
+        build is synchronous, and concurrent callers wait for it. Later
+        builds run in the background.
+        """
+        age = self.age()
+        if age is None:
+            with self._build_lock:
+                if self.updated is None:
+                    self._rebuild(users, app.logger)
+            return
+        if age < getattr(config, 'USER_INDEX_TTL', 300):
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=copy_current_request_context(self._rebuild),
+                         args=(users, app.logger),
+                         daemon=True).start()
+
+    def _rebuild(self, users, logger):
+        try:
+            start = time.time()
+            self.build(users.list_users(),
+                       [{'id': uid, 'roles': roles} for uid, roles in users.list().items()])
+            logger.info("User index rebuilt in %.2fs (%d users)",
+                        time.time() - start, len(self._data[0]))
+        except Exception as ex:
+            logger.error("Error while rebuilding user index: %s", ex)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def search(self, query, email=False, limit=None):
+        """Return the users whose id (or email, if `email` is true)
+        starts with or contains `query`. Prefix matches come first.
+        """
+        byid, keys, grams, id_only = self._data
+        query = query.lower()
+        matches = OrderedDict()
+        if limit is not None and limit <= 0:
+            return matches
+
+        def add(key, uid, is_email):
+            if email and uid in id_only:
+                return False
+            if (email or not is_email) and uid not in matches:
+                matches[uid] = byid[uid]
+            return limit is not None and len(matches) >= limit
+
+        # Prefix lookup
+        pos = bisect_left(keys, (query,))
+        while pos < len(keys) and keys[pos][0].startswith(query):
+            if add(*keys[pos]):
+                return matches
+            pos += 1
+
+        # Substring lookup
+        if len(query) >= 3:
+            candidates = None
+            for gram in trigrams(query):
+                candidates = grams.get(gram, set()) if candidates is None \
+                    else candidates.intersection(grams.get(gram, ()))
+            candidates = sorted(candidates)
+        else:
+            candidates = range(len(keys))
+        for pos in candidates:
+            if query in keys[pos][0] and add(*keys[pos]):
+                break
+        return matches
+
+
+user_index = UserIndex()
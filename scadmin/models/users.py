@@ -26,57 +26,118 @@ from flask import session
 
 from scadmin.auth import get_session
 from scadmin.exceptions import InsufficientAuthorization, NotFound
+from scadmin.models.roles import role_cache
+from scadmin.models.userindex import user_index
 from scadmin import config
 
 from keystoneclient.v3 import client as keystone_client
 from keystoneauth1.exceptions.http import Forbidden, NotFound as http_NotFound
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import json
 import re
 
+
+def assignment_tuples(role_assignments):
+    """Convert keystone role assignments of users on projects to
+    (user_id, project_id, role_id) tuples"""
+    return [(a.user['id'], a.scope['project']['id'], a.role['id'])
+            for a in role_assignments
+            if hasattr(a, 'user') and 'project' in a.scope]
+
+
+def fetch_users(keystone, uids, domain_id='default'):
+    """Return a dictionary {uid: user} for the users in `uids` that
+    belong to domain `domain_id`.
+
+    Users are listed in bulk with one call. If the policy does not allow
+    listing all the users, fall back to fetching them one by one, using
+    at most `config.USERS_FETCH_CONCURRENCY` concurrent requests.
+    """
+    uids = set(uids)
+    try:
+        return {u.id: u for u in keystone.users.list(domain=domain_id) if u.id in uids}
+    except Forbidden:
+        pass
+
+    def get(uid):
+        try:
+            return keystone.users.get(uid)
+        except http_NotFound:
+            # User not found. Ignoring
+            return None
+
+    workers = getattr(config, 'USERS_FETCH_CONCURRENCY', 8)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        users = list(pool.map(get, uids))
+    return {u.id: u for u in users if u is not None and u.domain_id == domain_id}
+
+
 class Users:
     def __init__(self):
         self.session = get_session()
         self.keystone = keystone_client.Client(session=self.session)
 
+    def _snapshot(self):
+        """Return the inventory snapshot, or None if the current user
+        is not allowed to use it"""
+        # imported here as the inventory itself depends on this module
+        from scadmin.models.inventory import inventory
+        if inventory.usable():
+            return inventory.get(self.keystone)
+        return None
+
+    def _projects(self, snapshot):
+        if snapshot:
+            return list(snapshot.projects.values())
+        return self.keystone.projects.list()
+
     def list(self):
         users = defaultdict(list)
-        rolenames  = {r.id: r.name for r in self.keystone.roles.list()}
 
-        for role in self.keystone.role_assignments.list():
-            users[role.user['id']].append({'project': role.scope['project']['id'],
-                                           'role': rolenames.get(role.role['id'])})
+        snapshot = self._snapshot()
+        if snapshot:
+            assignments = snapshot.assignments
+            rolenames = role_cache.names(self.keystone, assignments.roles)
+        else:
+            assignments = assignment_tuples(self.keystone.role_assignments.list())
+            rolenames = role_cache.names(self.keystone, {a[2] for a in assignments})
+        for uid, pid, rid in assignments:
+            users[uid].append({'project': pid,
+                               'role': rolenames.get(rid)})
         return users
 
     def list_users(self, project_admins=False):
         users = []
 
+        snapshot = self._snapshot()
         assignments = self.list()
-        try:
-            projects = {p.id: p for p in self.keystone.projects.list()}
-        except Forbidden:
-            projects = None
-        for uid in assignments:
+        if snapshot:
+            projects = snapshot.projects
+            kusers = snapshot.users
+        else:
             try:
-                user = self.keystone.users.get(uid)
-                if user.domain_id == 'default':
-                    roles = assignments.get(uid)
-                    if projects:
-                        for role in roles:
-                            role['project_name'] = projects[role['project']].name
-                    u = {'id':uid,
-                         'email':user.email,
-                         'roles': roles}
-                    users.append(u)
-            except http_NotFound:
-                # User not found. Ignoring
-                pass
+                projects = {p.id: p for p in self.keystone.projects.list()}
+            except Forbidden:
+                projects = None
+            kusers = fetch_users(self.keystone, assignments, 'default')
+        for uid, roles in assignments.items():
+            user = kusers.get(uid)
+            if user is None:
+                continue
+            if projects:
+                for role in roles:
+                    role['project_name'] = projects[role['project']].name
+            u = {'id':uid,
+                 'email':user.email,
+                 'roles': roles}
+            users.append(u)
         emails = [u['email'] for u in users]
 
         if project_admins:
-            for project in self.keystone.projects.list():
+            for project in self._projects(snapshot):
                 if not project.enabled:
                     continue
                 for attr in ['owner', 'contact', 's3it_owner']:
@@ -91,7 +152,20 @@ class Users:
 
         return users
 
-    def search(self, regexp, email=False):
+    def search(self, regexp, email=False, regex=False, limit=None):
+        """Search users by id (and email, if `email` is true).
+
+        Privileged users are served from the in-memory `user_index`,
+        matching `regexp` as a plain prefix or substring. Pass
+        `regex=True` to match it as a regular expression against a
+        fresh listing from keystone instead.
+        """
+        if not regex and set(session['auth']['roles']).intersection(['admin', 'usermanager']):
+            user_index.refresh(self)
+            users = user_index.search(regexp, email=email, limit=limit)
+            if email:
+                return users
+            return {uid: {'roles': u['roles']} for uid, u in users.items()}
         if email:
             return self._search_full(regexp)
         else:
@@ -134,7 +208,6 @@ class Users:
             raise NotFound('User %s not found' % uid)
 
         u['roles'] = roles = []
-        rolenames  = {r.id: r.name for r in self.keystone.roles.list()}
         try:
             projects = {p.id: p for p in self.keystone.projects.list(user=uid)}
         except Forbidden:
@@ -145,7 +218,7 @@ class Users:
             r = {'project': pid,
                  'role': rid,
                  'project_name': pid,
-                 'role_name': rolenames[rid],
+                 'role_name': role_cache.name(self.keystone, rid),
             }
             if projects:
                 r['project_name'] = projects[pid].name
@@ -158,7 +231,7 @@ class Users:
     def admin_emails(self):
         """List all email addresses listed in project fields like 'owner' and 's3it_owner'"""
         emails = set()
-        for project in self.keystone.projects.list():
+        for project in self._projects(self._snapshot()):
             if not project.enabled:
                 continue
             for attr in ['owner_email', 'contact_email', 's3it_owner_email']:
@@ -22,6 +22,103 @@
 __docformat__ = 'reStructuredText'
 __author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
 
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import threading
+import time
+
+from flask import current_app, copy_current_request_context, has_app_context, has_request_context
+
+
+def _with_context(func):
+    """Make the current flask request/app context available to `func`
+    when it runs in another thread"""
+    if has_request_context():
+        return copy_current_request_context(func)
+    if has_app_context():
+        app = current_app._get_current_object()
+        def wrapped():
+            with app.app_context():
+                return func()
+        return wrapped
+    return func
+
+def fan_out(calls, max_workers=None, timeout=None):
+    """Run concurrently the callables in the dictionary `calls`.
+
+    `timeout` is either a number of seconds or a dictionary with a
+    timeout for each key of `calls`. Returns two dictionaries
+    `results`, `errors` with the same keys as `calls`, holding the
+    returned values and the exceptions raised respectively. A call that
+    does not finish in time gets a `TimeoutError` in `errors`.
+
+    >>> results, errors = fan_out({'a': lambda: 1, 'b': lambda: 1/0})
+    >>> results
+    {'a': 1}
+    >>> errors
+    {'b': ZeroDivisionError('division by zero')}
+    """
+    if not calls:
+        return {}, {}
+    start = time.monotonic()
+    pool = ThreadPoolExecutor(max_workers=max_workers or len(calls))
+    futures = {key: pool.submit(_with_context(call)) for key, call in calls.items()}
+    results, errors = {}, {}
+    try:
+        for key, future in futures.items():
+            limit = timeout.get(key) if isinstance(timeout, dict) else timeout
+            wait = None if limit is None else max(0, start + limit - time.monotonic())
+            try:
+                results[key] = future.result(timeout=wait)
+            except TimeoutError:
+                future.cancel()
+                errors[key] = TimeoutError('%s: no answer after %ss' % (key, limit))
+            except Exception as ex:
+                errors[key] = ex
+    finally:
+        # Do not wait for the calls that timed out
+        pool.shutdown(wait=False)
+    return results, errors
+
+class RateLimiter(object):
+    """Token bucket allowing on average `rate` calls per second, with
+    bursts of at most `burst` calls.
+
+    `acquire` blocks until the call is allowed. Can be shared by
+    several threads.
+
+    >>> limit = RateLimiter(rate=100, burst=2)
+    >>> start = time.monotonic()
+    >>> for i in range(4): limit.acquire()
+    >>> time.monotonic() - start >= 0.02
+    True
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Book the token now, possibly going below zero, and wait
+            # for it outside the lock
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def wrap(self, func):
+        """Return `func`, called only when allowed by the limiter"""
+        def limited(*args, **kw):
+            self.acquire()
+            return func(*args, **kw)
+        return limited
+
 def to_bib(num):
     """Convert num to a reasonable power of 2.
 
@@ -24,33 +24,112 @@ __author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
 
 from datetime import datetime
 
-from flask import session, request, render_template, redirect, url_for, current_app as app
+from flask import session, request, render_template, redirect, url_for, current_app as app, Response, stream_with_context, abort
 from flask.json import jsonify
 from  werkzeug.datastructures import MultiDict
 
 from scadmin import config
-from scadmin.auth import authenticated, authenticate_with_token
-from scadmin.models.projects import Projects, Project
+from scadmin.auth import authenticated, authenticate_with_token, has_role
+from scadmin.models.projects import Projects, Project, page_projects, PROJECT_COLUMNS
 from scadmin.models.users import Users
 from scadmin.models.quota import Quota
+from scadmin.models.bulkquota import BulkQuota, select_projects
+from scadmin.models import export
+from scadmin.utils import to_bib
+from scadmin.models.inventory import inventory
 from scadmin.models.sympa import ML
 from scadmin.exceptions import InsufficientAuthorization, NotFound
 from scadmin.forms.create_project import CreateProjectForm
 from scadmin.forms.adduser import AddUserForm
-from scadmin.forms.quotas import SetQuotaForm
+from scadmin.forms.quotas import SetQuotaForm, BulkQuotaForm
 
 from . import main_bp
 
 
+def server_side():
+    """True if the project list is paginated by `projects_json`"""
+    return inventory.usable() and getattr(config, 'PROJECTS_SERVER_SIDE', True)
+
 @main_bp.route('/')
 @authenticated
 def list_projects():
     projects = Projects()
+    paged = server_side()
     return render_template('projects_list.html',
-                           # projects=[],
-                           projects=projects.list(),
+                           projects=[] if paged else projects.list(),
+                           server_side=paged,
                            auth=session['auth'],
-                           curproject=projects.project)
+                           curproject=projects.project,
+                           data_age=inventory.age() if inventory.usable() else None)
+
+@main_bp.route('projects.json')
+@authenticated
+def projects_json():
+    """One page of the project list, in the format of the DataTables
+    server-side processing protocol."""
+    args = request.args
+    columns = []
+    while 'columns[%d][data]' % len(columns) in args:
+        columns.append(args.get('columns[%d][data]' % len(columns)))
+    filters = {column: args.get('columns[%d][search][value]' % i, '')
+               for i, column in enumerate(columns) if column}
+    order = []
+    i = 0
+    while 'order[%d][column]' % i in args:
+        column = args.get('order[%d][column]' % i, type=int)
+        if column is not None and column < len(columns) and columns[column]:
+            order.append((columns[column], args.get('order[%d][dir]' % i, 'asc')))
+        i += 1
+
+    projects = Projects()
+    plist = projects.list()
+    filtered, page = page_projects(
+        plist,
+        search=args.get('search[value]', ''),
+        filters=filters,
+        order=order or [('name', 'asc')],
+        start=max(0, args.get('start', 0, type=int)),
+        length=min(max(1, args.get('length', 25, type=int)),
+                   getattr(config, 'PROJECTS_PAGE_MAX', 1000)))
+
+    auth = session['auth']
+    privileged = 'admin' in auth['roles'] or 'usermanager' in auth['roles']
+    data = []
+    for item in page:
+        project = item['p']
+        row = {column: getattr(project, column, None) or '' for column in PROJECT_COLUMNS[:-1]}
+        row['id'] = project.id
+        row['roles'] = str.join(', ', sorted(r for r in item.get('roles', []) if r))
+        if privileged or ('project_admin' in auth['roles'] and project.id == projects.project.id):
+            row['url'] = url_for('main.show_project', project_id=project.id)
+        if privileged:
+            row['quota_url'] = url_for('main.quota', project_id=project.id)
+        if project.name != auth['project_name'] and (auth['regular_member'] or item.get('myroles')):
+            row['active_url'] = url_for('main.set_active_project', project_id=project.id)
+        data.append(row)
+    return jsonify({
+        'draw': args.get('draw', 0, type=int),
+        'recordsTotal': len(plist),
+        'recordsFiltered': filtered,
+        'data': data,
+    })
+
+@main_bp.route('export/projects.<fmt>')
+@authenticated
+@has_role(['admin', 'usermanager'])
+def export_projects(fmt):
+    """Stream all enabled projects, with members and quota, as CSV or
+    newline-delimited JSON. Use `?quota=0` to skip the quota."""
+    with_quota = request.args.get('quota', '1') != '0'
+    rows = export.project_rows(with_quota=with_quota)
+    if fmt == 'csv':
+        body, mimetype = export.to_csv(rows, with_quota=with_quota), 'text/csv'
+    elif fmt == 'ndjson':
+        body, mimetype = export.to_ndjson(rows), 'application/x-ndjson'
+    else:
+        abort(404)
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename=projects.%s' % fmt})
 
 @main_bp.route('project/<project_id>/active')
 @authenticated
@@ -143,6 +222,8 @@ def show_project(project_id):
             data['users'] = data['project'].members()
     except InsufficientAuthorization:
         pass
+    # members are read from the inventory by privileged users
+    data['data_age'] = inventory.age() if inventory.usable() else None
 
     return render_template('project.html', **data)
 
@@ -166,6 +247,83 @@ def revoke_grant(project_id):
                             info="Role '%s' revoked from user '%s'" % (role, uid)))
 
 
+def quota_errors(quota):
+    return ["Unable to get %s quota: %s\n" % (service, ex)
+            for service, ex in sorted(quota.errors.items())]
+
+@main_bp.route('quota')
+@authenticated
+@has_role(['admin', 'usermanager'])
+def quota_overview():
+    projects = Projects().enabled()
+    quotas = Quota.overview([p.id for p in projects],
+                            refresh=bool(request.args.get('refresh')))
+    error = []
+    for project in projects:
+        error.extend("%s: %s" % (project.name, msg)
+                     for msg in quota_errors(quotas[project.id]))
+    return render_template('quota_overview.html',
+                           auth=session['auth'],
+                           projects=projects,
+                           quotas=quotas,
+                           error=error,
+                           to_bib=to_bib,
+                           data_age=inventory.age())
+
+def set_quota_validator(force):
+    """Return a function checking a quota dictionary with the rules of
+    `SetQuotaForm`"""
+    def validate(values):
+        form = SetQuotaForm(formdata=None, meta={'csrf': False},
+                            data=dict(values, comment='-', force=force))
+        try:
+            form.validate()
+        except Exception as ex:
+            return ["Invalid quota: %s" % ex]
+        return ["%s: %s" % (form[name].label.text, msg)
+                for name, messages in sorted(form.errors.items()) for msg in messages]
+    return validate
+
+@main_bp.route('bulk-quota', methods=['GET', 'POST'])
+@authenticated
+@has_role(['admin', 'usermanager'])
+def bulk_quota():
+    form = BulkQuotaForm()
+    data = {
+        'auth': session['auth'],
+        'error': [],
+        'info': [],
+        'form': form,
+        'results': None,
+        'to_bib': to_bib,
+    }
+    if form.validate_on_submit():
+        values = form.quota_values()
+        projects = select_projects(
+            Projects().enabled(),
+            names=(form.projects.data or '').split(),
+            faculty=(form.faculty.data or '').strip(),
+            institute=(form.institute.data or '').strip())
+        if not values:
+            data['error'].append("No quota values given")
+        elif not projects:
+            data['error'].append("No enabled project matches the selection")
+        else:
+            bulk = BulkQuota(values,
+                             delta=form.mode.data == 'add',
+                             validate=set_quota_validator(form.force.data),
+                             comment=form.comment.data)
+            results = data['results'] = bulk.run(projects, dry_run=form.dry_run.data)
+            applied = len([r for r in results if r['applied']])
+            failed = len([r for r in results if r['errors']])
+            if form.dry_run.data:
+                data['info'].append("Dry run: no quota was changed")
+            else:
+                data['info'].append("Quota updated on %d projects" % applied)
+            if failed:
+                data['error'].append("%d projects have errors" % failed)
+    return render_template('bulk_quota.html', **data)
+
 @main_bp.route('quota/<project_id>', methods=['GET', 'POST'])
 @authenticated
 def quota(project_id):
@@ -174,9 +332,12 @@ def quota(project_id):
         'error': [],
         'info': [],
         'form': None,
+        'to_bib': to_bib,
     }
-    data['quota'] = Quota(project_id)
+    # Always compute the changes against fresh values
+    data['quota'] = Quota(project_id, refresh=request.method == 'POST')
     project = data['project'] = Project(project_id)
+    data['error'].extend(quota_errors(data['quota']))
 
     if request.method == 'POST':
         data['form'] = SetQuotaForm(request.form)
@@ -185,8 +346,11 @@ def quota(project_id):
 
         if data['form'].validate():
             # Update quota
+            updated = {}
             try:
                 updated = data['quota'].set(data['form'].data)
+                for service, ex in sorted(updated.errors.items()):
+                    data['error'].append("Error while updating %s quota: %s\n" % (service, ex))
                 # Build updated message.
             except Exception as ex:
                 data['error'].append("Error while updating quota: %s\n" % ex)
@@ -199,7 +363,8 @@ def quota(project_id):
             except Exception as ex:
                 data['error'].append("Error while writing quota message: %s\n" % ex)
             try:
-                if not data['error']:
+                # Also record partial updates
+                if h_update or not data['error']:
                     # Update project
                     curdate = datetime.now().strftime('(%Y-%m-%d %H:%M)')
                     history = ["%s %s updated quota" % (curdate, session['auth']['user_id'])]
@@ -219,6 +384,7 @@ def quota(project_id):
                 data['error'].append('Error while updating history: %s\n' % ex)
             # set some message
             data['quota'] = Quota(project_id)
+            data['error'].extend(quota_errors(data['quota']))
             data['form'] = SetQuotaForm(MultiDict(data['quota'].to_dict()))
             if not data['quota'].has_swift():
                 del data['form'].s_bytes
@@ -238,11 +404,13 @@ def search_user():
     users = Users()
     uid = request.args.get('search')
     email = request.args.get('email', '')
+    regex = request.args.get('regex', '').lower() in ['1', 'yes', 'on']
+    limit = request.args.get('limit', getattr(config, 'USER_SEARCH_LIMIT', 50), type=int)
 
     if uid and email.lower() in ['1', 'yes', 'on']:
-        return jsonify(users.search(uid, email=True))
+        return jsonify(users.search(uid, email=True, regex=regex, limit=limit))
     elif uid:
-        return jsonify(users.search(uid))
+        return jsonify(users.search(uid, regex=regex, limit=limit))
     else:
         return jsonify(users.list())
 
@@ -26,6 +26,7 @@ from flask import session, request, render_template, redirect, url_for, current_
 from scadmin.auth import authenticated, has_role
 from scadmin.models.users import Users
 from scadmin.models.sympa import ML
+from scadmin.models.reconcile import reconciler
 from scadmin import config
 from scadmin.forms.sympa import SympaAddRemove
 
@@ -35,6 +36,7 @@ from . import sympa_bp
 @authenticated
 @has_role(['admin', 'usermanager'])
 def list_users():
+    """Show the latest result of the background reconciliation"""
     data = {
         'auth': session['auth'],
         'error': [],
@@ -45,41 +47,54 @@ def list_users():
     }
     form = data['form'] = SympaAddRemove(request.form)
 
-    scusers = data['scusers'] = Users()
-    ml = data['ml'] = ML()
+    keystone = Users().keystone
     try:
-        ml.login()
+        if request.args.get('refresh'):
+            reconciler.run(keystone, refresh=True)
+        result = reconciler.get(keystone)
     except Exception as ex:
         data['error'].append("Unable to access Sympa mailing list server: %s" % ex)
         return render_template('ml_users.html', **data)
-        
 
-    all_users = scusers.list_users(project_admins=False)
-    users_email = [u['email'] for u in all_users] + [i[1] for i in config.SYMPA_EMAIL_MAPPINGS if i[1]]
+    if request.method == 'POST':
+        form.email_add.choices = [(i,i) for i in result.missing]
+        form.email_remove.choices = [(i,i) for i in result.exceeding]
+        if form.validate():
+            ml = ML()
+            to_add = [f.data for f in form.email_add if f.checked]
+            to_remove = [f.data for f in form.email_remove if f.checked]
+            failed = False
+            try:
+                ml.login()
+                if to_add:
+                    info, err = ml.add(to_add)
+                    data['info'] += info
+                    data['error'] += err
+                    failed = failed or bool(err)
+                if to_remove:
+                    info, err = ml.remove(to_remove)
+                    data['info'] += info
+                    data['error'] += err
+                    failed = failed or bool(err)
+            except Exception as ex:
+                data['error'].append("Unable to access Sympa mailing list server: %s" % ex)
+                failed = True
+            try:
+                if failed:
+                    # Errors do not say which addresses failed: compare
+                    # again with what Sympa has now
+                    reconciler.run(keystone)
+                else:
+                    reconciler.update(added=to_add, removed=to_remove)
+            except Exception as ex:
+                data['error'].append("Unable to update the mailing list comparison: %s" % ex)
+            result = reconciler.result
+            form = data['form'] = SympaAddRemove(formdata=None)
 
-    missing_email, exceeding = ml.missing_and_exceeding(users_email)
-    data['exceeding'] = exceeding
-    missing = data['missing'] = [u for u in all_users if u['email'] in missing_email]
-
-    form.email_add.choices = [(i,i) for i in missing_email]
-    form.email_remove.choices = [(i,i) for i in exceeding]
-
-    if request.method == 'POST' and form.validate():
-        to_add = [f.data for f in form.email_add if f.checked]
-        if to_add:
-            info, err = ml.add(to_add)
-
-        to_remove = [f.data for f in form.email_remove if f.checked]
-        if to_remove:
-            info2, err2 = ml.remove(to_remove)
-            info += info2
-            err += err2
-
-        missing_email, exceeding = ml.missing_and_exceeding([u['email'] for u in all_users])
-        missing = [u for u in all_users if u['email'] in missing_email]
-
-        form.email_add.choices = [(i,i) for i in missing_email]
-        form.email_remove.choices = [(i,i) for i in exceeding]
-        return render_template('ml_users.html', **data)
+    data['missing'] = result.missing
+    data['exceeding'] = result.exceeding
+    data['result'] = result
+    form.email_add.choices = [(i,i) for i in result.missing]
+    form.email_remove.choices = [(i,i) for i in result.exceeding]
 
     return render_template('ml_users.html', **data)